@@ -11,6 +11,7 @@ EXAMPLES_DIR = os.path.dirname(__file__)
 def empty_fiole():
     """Empty the fiole."""
     default_app.routes[:] = DEFAULT_ROUTES
+    default_app.freeze()
     default_app.error_handlers = dict(DEFAULT_ERROR_HANDLERS)
     engine.global_vars = dict(DEFAULT_GLOBAL_VARS)
     LOADED_EXAMPLE[0] = '__init__'
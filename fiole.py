@@ -6,15 +6,25 @@ License: BSD (see LICENSE for details)
 """
 import ast
 import base64
-import cgi
 import hashlib
 import hmac
+import json
 import os
 import re
 import sys
+import tempfile
 import time
 import threading
 import traceback
+import uuid
+import warnings
+import zlib
+from collections import OrderedDict
+from copy import deepcopy
+try:
+    from collections.abc import Iterator, Mapping
+except ImportError:   # Python 2
+    from collections import Iterator, Mapping
 from datetime import datetime, timedelta
 from email.utils import mktime_tz, parsedate_tz
 from functools import update_wrapper, wraps
@@ -23,8 +33,7 @@ from wsgiref.handlers import format_date_time, FileWrapper
 try:                  # Python 3
     from http.client import responses as HTTP_CODES
     from http.cookies import SimpleCookie
-    from io import BytesIO
-    from urllib.parse import parse_qs
+    from urllib.parse import quote, unquote_plus, urlencode
     unicode = str
 
     def recode(s):
@@ -32,8 +41,7 @@ try:                  # Python 3
 except ImportError:   # Python 2
     from httplib import responses as HTTP_CODES
     from Cookie import SimpleCookie
-    from cStringIO import StringIO as BytesIO
-    from urlparse import parse_qs
+    from urllib import quote, unquote_plus, urlencode
     unicode = unicode
 
     def recode(s):
@@ -41,20 +49,39 @@ except ImportError:   # Python 2
 
 DEFAULT_BIND = {'host': '127.0.0.1', 'port': 8080}
 MAIN_MODULE = '__main__'
+if (3,) < sys.version_info < (3, 6):    # No bytes input before 3.6
+    def JSON_DECODER(s, _loads=json.loads):
+        return _loads(s.decode('utf-8'))
+else:
+    JSON_DECODER = json.loads
+URL_CONVERTERS = {
+    'str': (r'[^/]+', None),
+    'int': (r'\d+', int),
+    'uuid': (r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+             r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', uuid.UUID),
+    'path': (r'.+', None),
+}
+COMPRESS_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
 
 __version__ = '0.4.1'
 __all__ = ['HTTPError', 'BadRequest', 'Forbidden', 'NotFound',  # HTTP errors
-           'MethodNotAllowed', 'InternalServerError', 'Redirect',
+           'MethodNotAllowed', 'RequestEntityTooLarge', 'InternalServerError',
+           'NotModified', 'Redirect',
            # Base classes
            'Accept', 'HTTPHeaders', 'EnvironHeaders', 'Request', 'Response',
+           'MultiDict', 'RequestCookies', 'BodyReader', 'ChunkedReader',
+           'FileUpload', 'ResponseCache',
            # Decorators
            'route', 'get', 'post', 'put', 'delete', 'errorhandler',
+           'converter',
            # Template engine and static file helper
            'Loader', 'Lexer', 'Parser', 'BlockBuilder', 'Engine', 'Template',
            'engine', 'get_template', 'render_template', 'send_file',
+           'url_for', 'compress_response',
            # WSGI application and server
            'Fiole', 'default_app', 'get_app', 'run_wsgiref', 'run_fiole']
 _accept_re = re.compile(r'(?:^|,)\s*([^\s;,]+)(?:[^,]*?;\s*q=([\d.]*))?')
+_placeholder_re = re.compile(r'<(?:([a-zA-Z_]\w*):)?([a-zA-Z_]\w*)>')
 _new_module = type(re)
 
 
@@ -87,11 +114,29 @@ class NotFound(BadRequest):
 class MethodNotAllowed(BadRequest):
     status = 405
 
+    def __init__(self, message, hide_traceback=True, allowed=()):
+        super(MethodNotAllowed, self).__init__(message, hide_traceback)
+        self.allowed = allowed
+
+
+class RequestEntityTooLarge(BadRequest):
+    status = 413
+
 
 class InternalServerError(HTTPError):
     status = 500
 
 
+class NotModified(HTTPError):
+    """The resource matches the ``If-None-Match`` header of the request."""
+    status = 304
+
+    def __init__(self, etag=None):
+        super(NotModified, self).__init__("Not Modified",
+                                          hide_traceback=True)
+        self.etag = etag
+
+
 class Redirect(HTTPError):
     """Redirect the user to a different URL."""
     status = 302
@@ -109,6 +154,121 @@ def tobytes(value):
     return value.encode('utf-8') if isinstance(value, unicode) else value
 
 
+def _iter_encoded(chunks, charset):
+    """Encode the chunks lazily, and close the iterator at the end."""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(charset)
+            if chunk:
+                yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _iter_compressed(chunks, compressor):
+    """Compress the chunks lazily, and close the iterator at the end."""
+    try:
+        for chunk in chunks:
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
+def _compressible(content_type):
+    """Return True for the textual content types."""
+    content_type = content_type.partition(';')[0].strip().lower()
+    return (content_type.startswith('text/') or
+            content_type.endswith(('/json', '+json', '/xml', '+xml',
+                                   '/javascript')))
+
+
+def _etag_matches(header, etag):
+    """Return True if the ETag matches the ``If-None-Match`` header."""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag[:2] == 'W/' else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag[:2] == 'W/' else tag) == etag:
+            return True
+    return False
+
+
+def _to_buffers(output, zero_copy=False):
+    """Return the list of the non-empty chunks of a body.
+
+    The text is encoded to UTF-8.  The other bytes-like objects are copied
+    to bytes, unless ``zero_copy`` is set.
+    """
+    if not isinstance(output, (list, tuple)):
+        output = [output] if output else []
+    buffers = []
+    for chunk in output:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        elif not isinstance(chunk, bytes):
+            view = memoryview(chunk)
+            chunk = view.cast('B') if zero_copy else view.tobytes()
+        if len(chunk):
+            buffers.append(chunk)
+    return buffers
+
+
+def _sendmsg_all(sock, buffers):
+    """Send the buffers with scatter/gather I/O.  Return the size."""
+    views = [memoryview(chunk) for chunk in buffers]
+    (total, idx) = (0, 0)
+    while idx < len(views):
+        sent = sock.sendmsg(views[idx:idx + 1024])
+        total += sent
+        while sent:
+            size = len(views[idx])
+            if sent < size:
+                views[idx] = views[idx][sent:]
+                break
+            (sent, idx) = (sent - size, idx + 1)
+    return total
+
+
+def _native(value):
+    """Decode the UTF-8 bytes to a native string."""
+    return value if str is bytes else value.decode('utf-8', 'replace')
+
+
+def _parse_query(query, keep_blank_values=True):
+    """Decode the query string in a single pass, into a MultiDict."""
+    rv = MultiDict()
+    for field in query.split('&'):
+        (key, sep, value) = field.partition('=')
+        if not (value or (keep_blank_values and field)):
+            continue
+        if '%' in key or '+' in key:
+            key = unquote_plus(key)
+        if '%' in value or '+' in value:
+            value = unquote_plus(value)
+        rv.add(key, value)
+    return rv
+
+
+def _parse_header(value, _option=re.compile(
+        r';\s*([^\s;=]+)\s*(?:=\s*("(?:\\.|[^"\\])*"|[^;]*))?').findall):
+    """Return the lowercase value of the header and a dict of options."""
+    (value, sep, options) = value.partition(';')
+    params = {}
+    for (key, param) in _option(sep + options):
+        if param[:1] == '"':
+            param = param[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        params[key.lower()] = param.strip()
+    return (value.strip().lower(), params)
+
+
 def escape_html(s):
     """Escape special chars in HTML string."""
     if not isinstance(s, unicode):
@@ -148,10 +308,177 @@ def _get_root_folder():
         getattr(sys.modules[MAIN_MODULE], '__file__', '.')))
 
 
-def _url_matcher(url, _psub=re.compile(r'(<[a-zA-Z_]\w*>)').sub):
-    if '(?' not in url:
-        url = _psub(r'(?P\1[^/]+)', re.sub(r'([^<\w/>])', r'\\\1', url))
-    return re.compile("^%s/$" % url.rstrip('/'), re.U).match
+def _url_pattern(url, converters=None, _escape=re.compile(r'([^<\w/>])').sub,
+                 _split=_placeholder_re.split):
+    """Return the regex for the URL pattern, the list of ``(name, func)``
+    converters, and a flag if a placeholder can match a ``/``.
+    """
+    if '(?' in url:
+        return (url, [], True)
+    parts = _split(url)
+    (pattern, convert, spans) = (_escape(r'\\\1', parts[0]), [], False)
+    for idx in range(1, len(parts), 3):
+        (name, placeholder, literal) = parts[idx:idx + 3]
+        try:
+            (regex, func) = (converters or URL_CONVERTERS)[name or 'str']
+        except KeyError:
+            raise ValueError("Unknown converter %r in %r" % (name, url))
+        pattern += '(?P<%s>%s)%s' % (placeholder, regex,
+                                     _escape(r'\\\1', literal))
+        if func is not None:
+            convert.append((placeholder, func))
+        spans = spans or '/' in regex or bool(re.match('(?:%s)$' % regex, '/'))
+    return (pattern, convert, spans)
+
+
+def _url_matcher(url, converters=None):
+    pattern = _url_pattern(url, converters)[0]
+    return re.compile("^%s/$" % pattern.rstrip('/'), re.U).match
+
+
+def _url_builder(url, _split=_placeholder_re.split):
+    """Precompile the URL pattern into a function which builds the path.
+
+    The remaining parameters are appended as query string.
+    """
+    if '(?' in url:
+        raise ValueError("Cannot build the URL for %r" % url)
+    parts = _split(url)
+    (template, names) = (parts[0].replace('%', '%%'), [])
+    for idx in range(1, len(parts), 3):
+        (converter, name, literal) = parts[idx:idx + 3]
+        template += '%s' + literal.replace('%', '%%')
+        names.append((name, '/' if converter == 'path' else ''))
+
+    def build(params):
+        path = template % tuple([
+            quote(tobytes(unicode(params.pop(name))), safe)
+            for (name, safe) in names])
+        if params:
+            query = [(key, tobytes(unicode(value)))
+                     for (key, value) in sorted(params.items())]
+            path += '?' + urlencode(query)
+        return path
+    return build
+
+
+def _url_segments(url, converters=None,
+                  _pmatch=re.compile(r'<(?:str:)?([a-zA-Z_]\w*)>$').match):
+    """Split the URL pattern on ``/``, or return ``None`` for a regex.
+
+    A placeholder which can match a ``/`` is allowed in the last segment:
+    it matches the rest of the path.
+    """
+    if '(?' in url or url[:1] != '/':
+        return None
+    segments = url.rstrip('/')[1:].split('/') if url.strip('/') else []
+    plain = (converters or URL_CONVERTERS)['str'] == URL_CONVERTERS['str']
+    for (idx, segment) in enumerate(segments):
+        m = plain and _pmatch(segment)
+        if m:   # The placeholder matches a non-empty segment
+            segments[idx] = (segment, m.group(1), None, False)
+            continue
+        (pattern, convert, spans) = _url_pattern(segment, converters)
+        if '(?P<' in pattern:
+            if spans and idx < len(segments) - 1:
+                return None
+            pattern = re.compile('^%s$' % pattern, re.U)
+            segments[idx] = (segment, None, pattern.match, spans)
+    return segments
+
+
+def _convert(kwargs, convert):
+    """Apply the converters to the values of the placeholders."""
+    kwargs = dict(kwargs)
+    for (name, func) in convert:
+        kwargs[name] = func(kwargs[name])
+    return kwargs
+
+
+def _literal_prefix(pattern, _special=frozenset('.^$*+?{}[]|()')):
+    """Return the literal text which starts all the matches of the regex."""
+    if re.search(r'(?<!\\)(?:\\\\)*\||\(\?[aiLmsux]', pattern):
+        return ''       # An alternation or a flag could skip the prefix
+    (prefix, pos) = ('', 1 if pattern[:1] == '^' else 0)
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            pos += 1
+            char = pattern[pos:pos + 1]
+            if not char or char.isalnum():
+                break
+        elif char in _special:
+            break
+        pos += 1
+        if pattern[pos:pos + 1] in ('*', '?', '{'):
+            break       # This char is optional
+        prefix += char
+    return prefix
+
+
+def _disjoint(patterns):
+    """Check that no path can match two of these anchored patterns."""
+    prefixes = sorted([_literal_prefix(pattern) for pattern in patterns])
+    return all([not prefixes[idx + 1].startswith(prefixes[idx])
+                for idx in range(len(prefixes) - 1)])
+
+
+def _covers(segments, other):
+    """Return True if the first pattern matches all the paths of the other.
+
+    Both are lists of segments of the same length.
+    """
+    for (seg, oseg) in zip(segments, other):
+        if isinstance(seg, tuple):
+            if seg[1] is not None and oseg and not (
+                    isinstance(oseg, tuple) and oseg[3]):
+                continue    # A placeholder matches any non-empty segment
+            seg = seg[0]
+        if seg != (oseg[0] if isinstance(oseg, tuple) else oseg):
+            return False
+    return True
+
+
+def _combine_patterns(entries,
+                      max_groups=(99 if sys.version_info < (3, 5) else 0),
+                      _prefix=re.compile(r'\(\?P([<=])([a-zA-Z_]\w*)').sub,
+                      _alone=re.compile(r'\\[1-9]|\(\?[aiLmsux]+\)|'
+                                        r'\(\?\(').search):
+    """Compile the ``(pattern, target)`` entries into a few regexes.
+
+    Consecutive patterns are joined in one alternation, where each pattern
+    is a named group and its own groups are renamed with a prefix.  The
+    patterns with numbered references or global flags are kept alone.
+    Return a list of ``(match, target, alternatives)``.
+    """
+    def combine(run):
+        regex = re.compile('|'.join([
+            '(?P<_%d>%s)' % (idx, _prefix(r'(?P\1_%d_\2' % idx, pattern))
+            for (idx, (pattern, target)) in enumerate(run)]), re.U)
+        names = {}
+        for name in regex.groupindex:
+            (idx, sep, kw) = name[1:].partition('_')
+            if sep:
+                names.setdefault(int(idx), []).append((name, kw))
+        return (regex.match, None, dict([
+            (regex.groupindex['_%d' % idx], (target, names.get(idx, [])))
+            for (idx, (pattern, target)) in enumerate(run)]))
+
+    (matchers, run, ngroups) = ([], [], 0)
+    for (pattern, target) in entries:
+        size = re.compile(pattern, re.U).groups + 1
+        if run and (_alone(pattern) or
+                    (max_groups and ngroups + size > max_groups)):
+            matchers.append(combine(run))
+            (run, ngroups) = ([], 0)
+        if _alone(pattern):
+            matchers.append((re.compile(pattern, re.U).match, target, None))
+        else:
+            run.append((pattern, target))
+            ngroups += size
+    if run:
+        matchers.append(combine(run))
+    return matchers
 
 
 def _format_vkw(value, kw, _quoted=re.compile(r"[^\w!#$%&'*.^`|~+-]").search):
@@ -197,6 +524,178 @@ def lock_acquire(f):
     return wrapper
 
 
+class LRUCache(object):
+    """A mapping of limited size, which drops the least recently used keys.
+
+    It is thread-safe.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    @lock_acquire
+    def get(self, key, default=None):
+        """Return the value for the key, and mark it as recently used."""
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    @lock_acquire
+    def set(self, key, value):
+        """Store the value, drop the oldest key if full.  Return the value."""
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+        return value
+
+    @lock_acquire
+    def clear(self):
+        """Remove all the keys."""
+        self.data.clear()
+
+
+class ResponseCache(object):
+    """A cache of the encoded responses of the ``GET`` requests.
+
+    The responses are keyed by path, query string and the request headers
+    named in ``Vary``.  They expire after ``ttl`` seconds, and the least
+    recently used are dropped above ``max_size`` bytes.  It is thread-safe.
+    Set it as :attr:`Fiole.response_cache`, or use it as a decorator on
+    a route callback.
+
+    The cache is looked up after the pre-processing of the hooks and the
+    routing: a hit skips the callback and the post-processing of the
+    hooks.  The responses to a request with ``Authorization`` are not
+    stored, unless they are marked ``public`` or ``s-maxage``.  The
+    responses to a request with a ``Cookie`` are not stored, and the
+    stored responses are not served to it, unless they are marked
+    ``public`` or they vary on ``Cookie``.
+    """
+
+    def __init__(self, ttl=60, max_size=16 * 1024 * 1024):
+        (self.ttl, self.max_size, self.size) = (ttl, max_size, 0)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.vary = {}      # {(path, query): [vary, number of entries]}
+
+    def __len__(self):
+        return len(self.data)
+
+    def __call__(self, func):
+        """Cache the responses of this route callback."""
+        func.response_cache = self
+        return func
+
+    def _key(self, environ, vary=None):
+        base = (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                environ.get('QUERY_STRING', ''))
+        if vary is None:
+            vary = self.vary.get(base, ((),))[0]
+        return base + tuple(environ.get(name) for name in vary)
+
+    def _drop(self, key, entry):
+        """Forget the entry, which is already removed from the data."""
+        self.size -= entry[4]
+        counter = self.vary[key[:2]]
+        counter[1] -= 1
+        if not counter[1]:
+            del self.vary[key[:2]]
+
+    @lock_acquire
+    def get(self, environ):
+        """Return the ``(expires, status, headers, body, size)`` entry."""
+        key = self._key(environ)
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._drop(key, entry)
+            return None
+        self.data[key] = entry
+        return entry
+
+    @lock_acquire
+    def set(self, environ, status, headers, body, vary=()):
+        """Store the response, and drop the oldest entries if full."""
+        key = self._key(environ, vary)
+        size = (sum(len(chunk) for chunk in body) +
+                sum(len(k) + len(v) for (k, v) in headers))
+        old = self.data.pop(key, None)
+        if old is not None:
+            self._drop(key, old)
+        counter = self.vary.setdefault(key[:2], [vary, 0])
+        counter[:] = [vary, counter[1] + 1]
+        self.data[key] = (time.time() + self.ttl, status, headers, body, size)
+        self.size += size
+        while self.size > self.max_size:
+            self._drop(*self.data.popitem(last=False))
+
+    @lock_acquire
+    def clear(self):
+        """Remove all the entries."""
+        (self.size, self.data, self.vary) = (0, OrderedDict(), {})
+
+    def serve(self, environ, start_response):
+        """Send the cached response, or return None."""
+        method = environ['REQUEST_METHOD']
+        if method != 'GET' and method != 'HEAD':
+            return None
+        entry = self.get(environ)
+        if entry is None:
+            return None
+        (status, headers, body) = entry[1:4]
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            for (name, value) in headers:
+                if name == 'ETag' and _etag_matches(
+                        environ['HTTP_IF_NONE_MATCH'], value):
+                    start_response('304 Not Modified', [
+                        (k, v) for (k, v) in headers
+                        if k not in ('Content-Type', 'Content-Length')])
+                    return []
+        start_response(status, list(headers))
+        return body if method == 'GET' else []
+
+    def send(self, response, environ, start_response):
+        """Send the :class:`Response`, and store it if it is cacheable."""
+        captured = []
+
+        def capture(status, headers):
+            captured.extend((status, headers))
+            return start_response(status, headers)
+        body = response.send(environ, capture)
+        if environ['REQUEST_METHOD'] != 'GET' or not isinstance(body, list):
+            return body
+        (status, headers) = captured
+        cache_control = response.headers.get('Cache-Control', '').lower()
+        vary = response.headers.get('Vary', '')
+        if (status[:3] != '200' or 'Set-Cookie' in response.headers or
+                'no-store' in cache_control or 'private' in cache_control or
+                '*' in vary):
+            return body
+        vary = tuple('HTTP_' + name.strip().upper().replace('-', '_')
+                     for name in vary.split(',') if name.strip())
+        public = 'public' in cache_control
+        if environ.get('HTTP_AUTHORIZATION') and not (
+                public or 's-maxage' in cache_control):
+            return body         # RFC 7234, section 3.2
+        if not public and 'HTTP_COOKIE' not in vary:
+            if environ.get('HTTP_COOKIE'):
+                return body     # The response may depend on the session
+            vary += ('HTTP_COOKIE',)    # Not served to the sessions
+        if sum(len(chunk) for chunk in body) < self.max_size:
+            self.set(environ, status, list(headers), _to_buffers(body), vary)
+        return body
+
+
 class Accept(object):
     """Represent an ``Accept``-style header."""
 
@@ -280,6 +779,151 @@ class Accept(object):
         return lazyproperty(fget, func_name)
 
 
+def _unquote_cookie(value, _escape=re.compile(
+        r'\\(?:([0-3][0-7][0-7])|(.))').sub):
+    """Decode the quoted value of a cookie, like SimpleCookie."""
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return value
+    return _escape(lambda m: (chr(int(m.group(1), 8)) if m.group(1)
+                              else m.group(2)), value[1:-1])
+
+
+class RequestCookies(Mapping):
+    """The cookies of the request, decoded on first access.
+
+    The header is split once.  A malformed pair is skipped, without
+    losing the other cookies.
+    """
+
+    def __init__(self, header):
+        (self._raw, self._values) = ({}, {})
+        for pair in (header or '').split(';'):
+            (name, sep, value) = pair.partition('=')
+            name = name.strip()
+            if sep and name and name not in self._raw:
+                self._raw[name] = value.strip()
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            value = self._values[name] = _unquote_cookie(self._raw[name])
+            return value
+
+    def __contains__(self, name):
+        return name in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+
+class MultiDict(dict):
+    """A dictionary which keeps all the values of the repeated keys.
+
+    ``d[key]`` returns the first value, and :meth:`getall` the list of
+    all the values.  The pairs are stored in order in a flat list.
+    """
+
+    def __init__(self, items=()):
+        dict.__init__(self)
+        self._items = []
+        for (key, value) in self._pairs(items):
+            self.add(key, value)
+
+    @staticmethod
+    def _pairs(items):
+        if isinstance(items, MultiDict):
+            return items.allitems()
+        if hasattr(items, 'keys'):
+            return [(key, items[key]) for key in items.keys()]
+        return items
+
+    def __setitem__(self, key, value):
+        """Replace all the values of the key."""
+        if key in self:
+            del self[key]
+        self.add(key, value)
+
+    def __delitem__(self, key):
+        """Remove all the values of the key."""
+        dict.__delitem__(self, key)
+        self._discard(key)
+
+    def _discard(self, key):
+        self._items[:] = [item for pair in self.allitems() if pair[0] != key
+                          for item in pair]
+
+    def update(self, items=(), **kwargs):
+        """Replace the values of the keys, like ``dict.update``.
+
+        The values of a :class:`MultiDict` are all copied.
+        """
+        replaced = set()
+        for (key, value) in list(self._pairs(items)) + list(kwargs.items()):
+            if key in replaced:
+                self.add(key, value)
+            else:
+                replaced.add(key)
+                self[key] = value
+
+    def pop(self, key, *default):
+        """Remove the key, and return its first value."""
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = dict.pop(self, key)
+        self._discard(key)
+        return value
+
+    def popitem(self):
+        """Remove a key, and return it with its first value."""
+        (key, value) = dict.popitem(self)
+        self._discard(key)
+        return (key, value)
+
+    def setdefault(self, key, default=None):
+        """Add the value if the key is missing.  Return the first value."""
+        if key not in self:
+            self.add(key, default)
+        return dict.__getitem__(self, key)
+
+    def clear(self):
+        """Remove all the keys."""
+        dict.clear(self)
+        del self._items[:]
+
+    def copy(self):
+        """Return a shallow copy, with all the values."""
+        return self.__class__(self.allitems())
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.__class__(deepcopy(self.allitems(), memo))
+
+    def __reduce__(self):
+        return (self.__class__, (self.allitems(),))
+
+    def add(self, key, value):
+        """Add a value for the key, after the others."""
+        self._items.extend((key, value))
+        if key not in self:
+            dict.__setitem__(self, key, value)
+
+    def getall(self, key):
+        """Return the list of the values of the key."""
+        items = self._items
+        return [items[idx + 1] for idx in range(0, len(items), 2)
+                if items[idx] == key]
+
+    def allitems(self):
+        """Return the list of all the ``(key, value)`` pairs, in order."""
+        return list(zip(self._items[::2], self._items[1::2]))
+
+
 class HTTPHeaders(object):
     """An object that stores some headers."""
 
@@ -375,54 +1019,264 @@ class HTTPHeaders(object):
 
 
 class EnvironHeaders(HTTPHeaders):
-    """Headers from a WSGI environment.  Read-only view."""
+    """Headers from a WSGI environment.  Read-only view.
+
+    The list of the headers and their index by lowercase name are built
+    once, on first use.
+    """
 
     def __init__(self, environ):
         self.environ = environ
 
+    @lazyproperty
+    def _list(self):
+        headers = []
+        for (key, value) in self.environ.items():
+            if key.startswith('HTTP_'):
+                if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                    headers.append((key[5:].replace('_', '-').title(), value))
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                headers.append((key.replace('_', '-').title(), value))
+        return headers
+
+    @lazyproperty
+    def _index(self):
+        index = {}
+        for (name, value) in self._list:
+            index.setdefault(name.lower(), []).append(value)
+        return index
+
     def __getitem__(self, name):
         key = name.upper().replace('-', '_')
         if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
             return self.environ.get(key)
         return self.environ.get('HTTP_' + key)
 
-    def __iter__(self):
-        for (key, value) in self.environ.items():
-            if key.startswith('HTTP_'):
-                if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
-                    yield (key[5:].replace('_', '-').title(), value)
-            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
-                yield (key.replace('_', '-').title(), value)
+    def get_all(self, name):
+        """Return a list of all the values for the header."""
+        return list(self._index.get(name.lower(), ()))
 
-    def __len__(self):
-        return len([kv for kv in self])
+    def __contains__(self, name):
+        """Check if this header is present."""
+        return name.lower() in self._index
 
 
 # Request and Response
 
+class BodyReader(object):
+    """Read the body of the request by chunks, with a lookahead buffer."""
+
+    def __init__(self, read, length=None, buffer_size=65536):
+        (self.read, self.remaining) = (read, length)
+        (self.buffer_size, self.buf) = (buffer_size, b'')
+
+    def fill(self):
+        """Read the next chunk in the buffer.  Return False at the end."""
+        size = self.buffer_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        chunk = self.read(size) if size > 0 else b''
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self.buf += chunk
+        return bool(chunk)
+
+    def readline(self, limit=8192):
+        """Return the next line, without the line break."""
+        while True:
+            idx = self.buf.find(b'\n')
+            if idx >= 0:
+                (line, self.buf) = (self.buf[:idx], self.buf[idx + 1:])
+                return line.rstrip(b'\r')
+            if len(self.buf) > limit:
+                raise BadRequest("Line too long in the request body")
+            if not self.fill():
+                (line, self.buf) = (self.buf, b'')
+                return line
+
+    def iter_until(self, separator):
+        """Yield the chunks until the separator, which is consumed.
+
+        The line break before the separator is stripped.
+        """
+        keep = len(separator) + 1
+        while True:
+            idx = self.buf.find(separator)
+            if idx >= 0:
+                (chunk, self.buf) = (self.buf[:idx],
+                                     self.buf[idx + len(separator):])
+                yield chunk[:-1] if chunk[-1:] == b'\r' else chunk
+                return
+            if len(self.buf) > keep:
+                (chunk, self.buf) = (self.buf[:-keep], self.buf[-keep:])
+                yield chunk
+            if not self.fill():
+                raise BadRequest("Unexpected end of the request body")
+
+
+class ChunkedReader(object):
+    """Decode a body sent with ``Transfer-Encoding: chunked``.
+
+    It wraps the raw input stream; :meth:`read` returns an empty string
+    after the last chunk, and the trailers are discarded.
+    """
+
+    def __init__(self, stream):
+        (self.stream, self.chunk_left, self.done) = (stream, 0, False)
+
+    def _next_chunk(self):
+        line = self.stream.readline(8192)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise BadRequest("Invalid chunk size")
+        if size == 0:
+            while self.stream.readline(8192) not in (b'\r\n', b'\n', b''):
+                pass                # Discard the trailers
+            self.done = True
+        self.chunk_left = size
+
+    def read(self, size=-1):
+        """Read at most ``size`` bytes of the decoded body, or the rest."""
+        chunks = []
+        while size and not self.done:
+            if not self.chunk_left:
+                self._next_chunk()
+                continue
+            count = self.chunk_left
+            if 0 < size < count:
+                count = size
+            chunk = self.stream.read(count)
+            if not chunk:
+                raise BadRequest("Unexpected end of the request body")
+            chunks.append(chunk)
+            self.chunk_left -= len(chunk)
+            if not self.chunk_left:
+                self.stream.readline(8192)      # The CRLF after the chunk
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+class FileUpload(object):
+    """A file uploaded with a ``multipart/form-data`` request.
+
+    The content is available in :attr:`file`.  It is spooled to
+    a temporary file when it is large.
+    """
+
+    def __init__(self, name, filename, headers, file):
+        (self.name, self.filename) = (name, filename)
+        (self.headers, self.file) = (headers, file)
+        (self.type, self.type_options) = _parse_header(
+            headers.get('Content-Type', 'text/plain'))
+        (self.disposition, self.disposition_options) = _parse_header(
+            headers.get('Content-Disposition', ''))
+
+    @property
+    def value(self):
+        """The content of the file, as bytes."""
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(0)
+        return value
+
+
+def _parse_multipart(reader, boundary, spool_size):
+    """Yield ``(name, value)`` for each part of the multipart body.
+
+    The value is a string, a :class:`FileUpload`, or a list of
+    :class:`FileUpload` for a nested ``multipart/mixed`` part.
+    """
+    separator = b'\n--' + boundary
+    reader.buf = b'\n' + reader.buf
+    for chunk in reader.iter_until(separator):
+        pass    # Skip the preamble
+    while not reader.readline().startswith(b'--'):
+        headers = HTTPHeaders()
+        for line in iter(reader.readline, b''):
+            (key, sep, value) = _native(line).partition(':')
+            headers.add(key.strip(), value.strip())
+        (disposition, options) = _parse_header(
+            headers.get('Content-Disposition', ''))
+        (content_type, type_options) = _parse_header(
+            headers.get('Content-Type', 'text/plain'))
+        (filename, file) = (options.get('filename'),
+                            tempfile.SpooledTemporaryFile(spool_size))
+        for chunk in reader.iter_until(separator):
+            file.write(chunk)
+            if (filename is None and content_type != 'multipart/mixed' and
+                    file.tell() > spool_size):
+                raise BadRequest("Form field is too large")
+        file.seek(0)
+        if content_type == 'multipart/mixed':
+            nested = BodyReader(file.read, None, reader.buffer_size)
+            value = [upload for (name, upload) in _parse_multipart(
+                nested, tobytes(type_options.get('boundary', '')),
+                spool_size)]
+        elif filename is not None:
+            value = FileUpload(options.get('name'), filename, headers, file)
+        else:
+            value = _native(file.read())
+        yield (options.get('name'), value)
+
+
 class Request(object):
-    """An object to wrap the environ bits in a friendlier way."""
+    """An object to wrap the environ bits in a friendlier way.
+
+    The routing fields ``path`` and ``method`` are computed once.  The
+    other basic fields are computed on first access.  They are stored
+    in slots.
+    """
+    __slots__ = ('environ', 'path', 'script_name', 'method', 'query',
+                 'headers', 'content_length', '_remaining', '_received',
+                 '__dict__')
+    buffer_size = 65536
+    spool_size = 1024 * 1024
+    max_body_size = None
+    _buffers = threading.local()
 
     def __init__(self, environ):
         self.environ = environ
-        self.path = recode(environ.get('PATH_INFO', '/'))
-        if self.path[-1:] != '/':
-            self.path += '/'
-        self.script_name = environ.get('SCRIPT_NAME', '').rstrip('/')
+        path = recode(environ.get('PATH_INFO', '/'))
+        self.path = path if path[-1:] == '/' else path + '/'
         self.method = environ.get('REQUEST_METHOD', 'GET').upper()
-        self.query = environ.get('QUERY_STRING', '')
-        self.headers = EnvironHeaders(environ)
-        try:
-            self.content_length = int(self.headers['Content-Length'] or 0)
-        except ValueError:
-            self.content_length = 0
     accept = Accept.header('Accept', 'accept')
     accept_charset = Accept.header('Accept-Charset', 'accept_charset')
     accept_encoding = Accept.header('Accept-Encoding', 'accept_encoding')
     accept_language = Accept.header('Accept-Language', 'accept_language')
 
+    def _get_remaining(self):
+        environ = self.environ
+        if (environ.get('wsgi.input_terminated') and
+                not environ.get('CONTENT_LENGTH')):
+            return None     # The body has no length, read until the end
+        return self.content_length
+
+    def _get_content_length(self):
+        try:
+            return int(self.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 0
+
+    _fields = {
+        'script_name': lambda self: (self.environ.get('SCRIPT_NAME', '')
+                                     .rstrip('/')),
+        'query': lambda self: self.environ.get('QUERY_STRING', ''),
+        'headers': lambda self: EnvironHeaders(self.environ),
+        'content_length': _get_content_length,
+        '_remaining': _get_remaining,
+        '_received': lambda self: 0,
+    }
+
     def __getattr__(self, name):
-        """Access the environment."""
+        """Compute the basic fields, or access the environment."""
+        if name in self._fields:
+            value = self._fields[name](self)
+            setattr(self, name, value)
+            return value
         try:
             return self.environ[name]
         except KeyError:
@@ -431,12 +1285,12 @@ class Request(object):
 
     @lazyproperty
     def GET(self):
-        """A dictionary of GET parameters."""
+        """A :class:`MultiDict` of GET parameters."""
         return self.build_get_dict()
 
     @lazyproperty
     def POST(self):
-        """A dictionary of POST (or PUT) values, including files."""
+        """A :class:`MultiDict` of POST (or PUT) values, including files."""
         return self.build_complex_dict()
     PUT = POST
 
@@ -455,23 +1309,137 @@ class Request(object):
     @lazyproperty
     def body(self):
         """Content of the request."""
-        return self.environ['wsgi.input'].read(self.content_length)
+        return b''.join(iter(self.read, b''))
+
+    @property
+    def stream(self):
+        """Iterate over the body, by chunks of :attr:`buffer_size`."""
+        return iter(lambda: self.read(self.buffer_size), b'')
+
+    def read(self, size=-1):
+        """Read at most ``size`` bytes of the body, or the remaining."""
+        size = self._next_size(size)
+        if size == 0:
+            return b''
+        stream = self.environ['wsgi.input']
+        chunk = stream.read(size) if size > 0 else stream.read()
+        self._consume(len(chunk))
+        return chunk
+
+    def readinto(self, buffer):
+        """Read the body into a writable buffer.
+
+        Return the number of bytes read, ``0`` at the end of the body.
+        """
+        view = memoryview(buffer)
+        size = self._next_size(len(view))
+        if size == 0:
+            return 0
+        stream = self.environ['wsgi.input']
+        if hasattr(stream, 'readinto'):
+            count = stream.readinto(view[:size]) or 0
+        else:
+            chunk = stream.read(size)
+            count = len(chunk)
+            view[:count] = chunk
+        self._consume(count)
+        return count
+
+    def read_body_into(self, buffer=None):
+        """Read the whole body into a buffer, and return a ``memoryview``.
+
+        Without ``buffer``, a ``bytearray`` is reused by the requests of
+        the same thread, and it grows with the bytes received, not with
+        the ``Content-Length``: the view is valid until the next call in
+        this thread.  A given buffer is not resized, and a larger body
+        raises :exc:`RequestEntityTooLarge`.
+        """
+        reuse = buffer is None
+        if reuse:
+            buffer = getattr(self._buffers, 'body', None)
+            if buffer is None or len(buffer) < self.buffer_size:
+                buffer = self._buffers.body = bytearray(self.buffer_size)
+        (view, count) = (memoryview(buffer), 0)
+        while True:
+            if count == len(view):
+                if self._remaining == 0:
+                    break
+                if not reuse:
+                    if self.read(1):
+                        raise RequestEntityTooLarge("The request body is "
+                                                    "larger than the buffer.")
+                    break
+                buffer = self._buffers.body = bytearray(2 * count)
+                buffer[:count] = view
+                view = memoryview(buffer)
+            size = self.readinto(view[count:])
+            if not size:
+                break
+            count += size
+        return view[:count]
+
+    def _next_size(self, size):
+        """Return the size of the next read, or ``-1`` for the rest."""
+        remaining = self._remaining
+        if remaining is None:   # Read until the end of the input
+            if self.max_body_size is None:
+                return size
+            # Read one more byte to detect a body which is too large
+            remaining = self.max_body_size + 1 - self._received
+        return max(remaining, 0) if (size < 0 or size > remaining) else size
+
+    def _consume(self, count):
+        if self._remaining is not None:
+            self._remaining -= count
+            return
+        self._received += count
+        if (self.max_body_size is not None and
+                self._received > self.max_body_size):
+            raise RequestEntityTooLarge("The request body is limited to "
+                                        "%d bytes." % self.max_body_size)
+
+    def limit_body(self, max_body_size):
+        """Set the :attr:`max_body_size` of the request.
+
+        Raise :exc:`RequestEntityTooLarge` if the ``Content-Length`` is
+        larger, before the body is read.  Without ``Content-Length``, it
+        is checked while the body is read.
+        """
+        self.max_body_size = max_body_size
+        if self.content_length > max_body_size:
+            raise RequestEntityTooLarge("The request body is limited to "
+                                        "%d bytes." % max_body_size)
 
     @lazyproperty
-    def cookies(self):
-        """A dictionary of Cookie.Morsel objects."""
-        cookies = SimpleCookie()
+    def json(self):
+        """The decoded JSON body, or ``None`` for another content type.
+
+        The bytes are decoded with the ``json_decoder`` of the
+        application.
+        """
+        content_type = (self.headers['Content-Type'] or '').partition(';')[0]
+        content_type = content_type.strip().lower()
+        if not (content_type == 'application/json' or
+                content_type.endswith('+json')):
+            return None
+        body = self.body
+        if not body:
+            return None
+        app = self.environ.get('fiole.app')
+        decoder = app.json_decoder if app is not None else JSON_DECODER
         try:
-            cookies.load(self.headers["Cookie"])
-        except Exception:
-            pass
-        return cookies
+            return decoder(body)
+        except ValueError:
+            raise BadRequest("The JSON body cannot be decoded.")
+
+    @lazyproperty
+    def cookies(self):
+        """A :class:`RequestCookies` mapping of the cookie values."""
+        return RequestCookies(self.environ.get('HTTP_COOKIE'))
 
     def get_cookie(self, name, default=None):
         """Get the value of the cookie with the given name, else default."""
-        if name in self.cookies:
-            return self.cookies[name].value
-        return default
+        return self.cookies.get(name, default)
 
     def get_secure_cookie(self, name, value=None, max_age_days=31):
         """Return the given signed cookie if it validates, or None."""
@@ -481,29 +1449,43 @@ class Request(object):
         return app.decode_signed(name, value, max_age_days=max_age_days)
 
     def build_get_dict(self):
-        """Take GET data and rip it apart into a dict."""
-        raw_query_dict = parse_qs(self.query, keep_blank_values=1)
-        query_dict = {}
-
-        for (key, value) in raw_query_dict.items():
-            query_dict[key] = value if len(value) > 1 else value[0]
-        return query_dict
+        """Take GET data and rip it apart into a MultiDict."""
+        return _parse_query(self.query)
 
     def build_complex_dict(self):
-        """Take POST/PUT data and rip it apart into a dict."""
-        environ = self.environ.copy()
-        environ['QUERY_STRING'] = ''    # Don't mix GET and POST variables
-        raw_data = cgi.FieldStorage(fp=BytesIO(self.body), environ=environ)
-        post_dict = {}
-
-        for field in raw_data:
-            if isinstance(raw_data[field], list):
-                post_dict[field] = [fs.value for fs in raw_data[field]]
-            elif raw_data[field].filename:
-                post_dict[field] = raw_data[field]  # We've got a file.
-            else:
-                post_dict[field] = raw_data[field].value
-        return post_dict
+        """Take POST/PUT data and rip it apart into a MultiDict.
+
+        The ``multipart/form-data`` content is parsed by chunks, and the
+        files are spooled to temporary files above :attr:`spool_size`.
+        """
+        if ('body' not in self.__dict__ and
+                self._remaining is not None and self._remaining <= 0):
+            return MultiDict()
+        (content_type, options) = _parse_header(
+            self.headers['Content-Type'] or '')
+        if content_type == 'application/x-www-form-urlencoded':
+            return _parse_query(_native(self.body), keep_blank_values=False)
+        if content_type == 'multipart/form-data':
+            if not options.get('boundary'):
+                raise BadRequest("Missing boundary in multipart content")
+            reader = BodyReader(self.read, None, self.buffer_size)
+            if 'body' in self.__dict__:     # The body is already read
+                reader.buf = self.body
+            return MultiDict(_parse_multipart(
+                reader, tobytes(options['boundary']), self.spool_size))
+        return MultiDict()
+
+    def check_etag(self, version):
+        """Raise :exc:`NotModified` if this version of the resource is cached.
+
+        The ``version`` is a cheap key, like a revision number: call it
+        before rendering.  It is sent as a weak ``ETag`` of the response.
+        """
+        etag = 'W/"%s"' % (version,)
+        if (self.method in ('GET', 'HEAD') and
+                _etag_matches(self.environ.get('HTTP_IF_NONE_MATCH'), etag)):
+            raise NotModified(etag)
+        self.environ['fiole.etag'] = etag
 
     def get_url(self, path='', full=False):
         """Build the absolute URL for an application path.
@@ -518,9 +1500,20 @@ class Request(object):
             return self.host_url + self.script_name + path
         return self.script_name + path
 
+    def url_for(self, route_name, **params):
+        """Build the absolute path of a named route.
+
+        The route is searched in the application which handles the
+        request, and the path starts with the ``SCRIPT_NAME``.
+        """
+        app = self.environ['fiole.app']
+        return self.script_name + app.url_for(route_name, **params)
+
 
 class Response(object):
     charset = 'utf-8'
+    compress_min_size = 1024
+    compress_level = 6
 
     def __init__(self, output, headers=None, status=200,
                  content_type='text/html', wrapped=False):
@@ -568,13 +1561,61 @@ class Response(object):
         self.set_cookie(
             name, value, expires_days=expires_days, signed=True, **kwargs)
 
+    def compress(self, accept_encoding, min_size=None, level=None):
+        """Compress the body with ``gzip`` or ``deflate``.
+
+        The encoding is the best match in the :class:`Accept` header.
+        The body is unchanged for the small bodies, the responses with
+        a ``Content-Encoding`` and the content types which are not text.
+        An iterator is compressed incrementally.
+        """
+        if (self.wrapped or self.status in (204, 304) or self.status < 200 or
+                'Content-Encoding' in self.headers or
+                not _compressible(self.headers.get('Content-Type', ''))):
+            return
+        if min_size is None:
+            min_size = self.compress_min_size
+        output = self.output
+        if not isinstance(output, Iterator):
+            output = b''.join(_to_buffers(output))
+            if len(output) < min_size:
+                return
+        vary = self.headers['Vary']
+        if not vary:
+            self.headers['Vary'] = 'Accept-Encoding'
+        elif vary != '*' and 'accept-encoding' not in vary.lower():
+            self.headers['Vary'] = vary + ', Accept-Encoding'
+        encoding = accept_encoding.best_match(('gzip', 'deflate'))
+        if encoding is None:
+            return
+        if level is None:
+            level = self.compress_level
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      COMPRESS_WBITS[encoding])
+        if isinstance(output, Iterator):
+            self.output = _iter_compressed(
+                _iter_encoded(output, self.charset), compressor)
+            del self.headers['Content-Length']
+        else:
+            self.output = compressor.compress(output) + compressor.flush()
+        self.headers['Content-Encoding'] = encoding
+
     def send(self, environ, start_response):
         """Send the headers and return the body of the response."""
+        output = self.output
+        if self.status == 200 and 'fiole.etag' in environ:
+            self.headers.setdefault('ETag', environ['fiole.etag'])
+        if self.wrapped:
+            body = output or []
+        elif isinstance(output, Iterator):
+            body = _iter_encoded(output, self.charset)
+        else:
+            body = _to_buffers(output, environ.get('fiole.buffers'))
+            self.headers['Content-Length'] = str(sum(map(len, body)))
+            method = environ['REQUEST_METHOD']
+            if self.status == 200 and (method == 'GET' or method == 'HEAD'):
+                body = self._check_etag(environ, body)
         status = "%d %s" % (self.status, HTTP_CODES.get(self.status))
-        body = (self.output if self.wrapped else
-                [tobytes(self.output)]) if self.output else []
-        if not self.wrapped:
-            self.headers['Content-Length'] = str(body and len(body[0]) or 0)
         if hasattr(self, "_new_cookie"):
             app = environ['fiole.app']
             for cookie in self._new_cookie.values():
@@ -585,20 +1626,348 @@ class Response(object):
         start_response(status, self.headers.to_list())
         if environ['REQUEST_METHOD'] != 'HEAD':
             return body
-        if hasattr(body, 'close'):
-            body.close()
+        if hasattr(output, 'close'):
+            output.close()
+        return []
+
+    def _check_etag(self, environ, body):
+        etag = self.headers['ETag']
+        if etag is None:
+            if not getattr(environ.get('fiole.app'), 'auto_etag', False):
+                return body
+            sha = hashlib.sha1()
+            for chunk in body:
+                sha.update(chunk)
+            etag = self.headers['ETag'] = '"%s"' % sha.hexdigest()
+        if not _etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            return body
+        self.status = 304
+        del self.headers['Content-Type'], self.headers['Content-Length']
         return []
 
 
+def compress_response(request):
+    """Hook which compresses the responses, if the client accepts it.
+
+    Register it with ``app.hooks.append(compress_response)``.
+    """
+    response = yield
+    response.compress(request.accept_encoding)
+    yield response
+
+
+class RouteNode(object):
+    """A node of the routing tree, for one segment of the path."""
+    __slots__ = ('literals', 'wildcards', 'targets')
+
+    def __init__(self):
+        (self.literals, self.wildcards, self.targets) = ({}, [], [])
+
+    def insert(self, segments, target):
+        """Add the target at the end of the branch for these segments."""
+        node = self
+        for segment in segments:
+            if not isinstance(segment, tuple):
+                node = node.literals.setdefault(segment, RouteNode())
+                continue
+            for (key, name, seg_match, spans, child) in node.wildcards:
+                if key == segment[0]:
+                    node = child
+                    break
+            else:
+                node.wildcards.append(segment + (RouteNode(),))
+                node = node.wildcards[-1][-1]
+        node.targets.append(target)
+
+    def collect(self, segments, pos, kwargs, found):
+        """Append the ``(target, kwargs)`` which match the segments."""
+        if pos == len(segments):
+            found.extend([(target, kwargs) for target in self.targets])
+            return
+        segment = segments[pos]
+        if segment in self.literals:
+            self.literals[segment].collect(segments, pos + 1, kwargs, found)
+        for (key, name, seg_match, spans, child) in self.wildcards:
+            if name is not None:
+                if not segment:
+                    continue
+                kw = dict(kwargs)
+                kw[name] = segment
+            else:
+                m = seg_match('/'.join(segments[pos:]) if spans else segment)
+                if not m:
+                    continue
+                kw = dict(kwargs)
+                kw.update(m.groupdict())
+            # The placeholder which can match a '/' consumes the path
+            child.collect(segments, len(segments) if spans else pos + 1,
+                          kw, found)
+
+
+class RouteIndex(object):
+    """Index of dynamic routes: a tree of path segments and some regexes.
+
+    The routes with the easy syntax are stored in a tree of path segments,
+    where only the placeholders need a regex.  The lookup cost depends on
+    the depth of the path, not on the number of routes.  The routes with
+    the regex syntax are tried one after the other.
+
+    With ``combined=True``, all the routes are compiled into an alternation
+    of named groups instead, and a single ``match`` call finds the first
+    route which matches the path.
+
+    When no path can match two of the routes, the index is ``disjoint``
+    and the regex routes may be tried in any order.  The rejected regex
+    routes are counted in the ``misses`` list, if provided.
+    """
+
+    def __init__(self, entries, combined=False, misses=None):
+        self.tree = RouteNode()
+        self.regex_routes = []
+        self.misses = misses
+        patterns = []
+        for (target, pattern, re_match, segments) in entries:
+            if segments is None or combined:
+                self.regex_routes.append((re_match, target))
+                patterns.append((pattern, target))
+            else:
+                self.tree.insert(segments, target)
+        self.combined = _combine_patterns(patterns) if combined else None
+        self.disjoint = _disjoint([entry[1] for entry in entries])
+
+    def collect(self, path):
+        """Return the sorted ``(target, kwargs)`` of the matching routes."""
+        found = []
+        if path[:1] == '/':
+            segments = path[1:-1].split('/') if path != '/' else []
+            self.tree.collect(segments, 0, {}, found)
+        for (re_match, target) in self.regex_routes:
+            m = re_match(path)
+            if m:
+                found.append((target, m.groupdict()))
+        return sorted(found)
+
+    def first(self, path):
+        """Return the ``(target, kwargs)`` of the first matching route."""
+        if self.combined is not None:
+            return self.first_combined(path)
+        found = []
+        if path[:1] == '/':
+            segments = path[1:-1].split('/') if path != '/' else []
+            self.tree.collect(segments, 0, {}, found)
+        best = min(found) if found else None
+        if best is not None and self.disjoint:
+            return best
+        misses = self.misses
+        for (re_match, target) in self.regex_routes:
+            if best is not None and target > best[0]:
+                break
+            m = re_match(path)
+            if m:
+                return (target, m.groupdict())
+            if misses is not None:
+                misses[target[0]] += 1
+        return best
+
+    def first_combined(self, path):
+        for (match, target, alternatives) in self.combined:
+            m = match(path)
+            if m is None:
+                continue
+            if alternatives is None:
+                return (target, m.groupdict())
+            (target, names) = alternatives[m.lastindex]
+            return (target, dict([(kw, m.group(name))
+                                  for (name, kw) in names]))
+
+
+class Router(object):
+    """Dispatch table compiled from the routes of the application.
+
+    The routes without placeholder are stored in a dictionary, with
+    the resolution precomputed for their path and for each method.
+    The dynamic routes are indexed by HTTP method, each in
+    a :class:`RouteIndex`.  When the method lookup misses, the path-only
+    index finds the allowed methods for the ``405`` error.
+
+    The routes which are shadowed by a previous route are listed in
+    :attr:`shadowed` as ``(index, methods, previous_index)``.
+
+    With a positive ``cache_size``, the resolution of the dynamic routes
+    is kept in a :class:`LRUCache`, including the errors.
+
+    With ``stats=True``, the matches of each route are counted in
+    :attr:`hits`, and the regex routes which are tried and rejected
+    in :attr:`misses`.  The counters are approximate when the requests
+    run in threads.  With a positive ``reorder_interval``, the regex
+    routes of a ``disjoint`` :class:`RouteIndex` are sorted by hits,
+    each time this number of dynamic paths are resolved.
+
+    The ``converters`` map the name of a converter to its ``(regex,
+    func)``.  When the function raises :exc:`ValueError`, the route
+    does not match.
+    """
+
+    def __init__(self, routes, combined=False, cache_size=0,
+                 converters=None, stats=False, reorder_interval=0):
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        if stats or reorder_interval > 0:
+            (self.hits, self.misses) = ([0] * len(routes), [0] * len(routes))
+        else:
+            (self.hits, self.misses) = (None, None)
+        self.reorder_interval = self._countdown = max(reorder_interval, 0)
+        (static, dynamic, shapes) = ({}, [], {})
+        (shadowed, converts) = ({}, {})
+        for (index, route) in enumerate(routes):
+            (url, re_match, methods, callback, status) = route
+            segments = _url_segments(url, converters)
+            if segments is not None and not any(
+                    isinstance(segment, tuple) for segment in segments):
+                static.setdefault(url.rstrip('/') + '/', []).append(index)
+                continue
+            (pattern, convert, spans) = _url_pattern(url, converters)
+            converts[index] = tuple(convert)
+            pattern = "^%s/$" % pattern.rstrip('/')
+            dynamic.append((index, pattern, re_match, segments))
+            # Look for a previous route which matches the same paths
+            shape = len(segments) if segments is not None else url
+            for previous in shapes.setdefault(shape, []):
+                if segments is None or _covers(previous[3], segments):
+                    for method in methods:
+                        if method in previous[1]:
+                            shadowed.setdefault(index, {}).setdefault(
+                                method, previous[0])
+            shapes[shape].append((index, methods, url, segments))
+
+        self.paths = RouteIndex([((i, routes[i][2], converts[i]),
+                                  pat, re_match, segs)
+                                 for (i, pat, re_match, segs) in dynamic])
+        self.methods = {}
+        for method in set([m for entry in dynamic
+                           for m in routes[entry[0]][2]]):
+            self.methods[method] = RouteIndex(
+                [((i, routes[i][3], routes[i][4], converts[i]),
+                  pat, re_match, segs)
+                 for (i, pat, re_match, segs) in dynamic
+                 if method in routes[i][2]], combined, self.misses)
+        self.static = {}
+        for (path, indexes) in static.items():
+            (resolved, winners) = ({}, {})
+            found = [(index, {}) for index in indexes]
+            found += [(target[0], kwargs)
+                      for (target, kwargs) in self.paths.collect(path)]
+            for (index, kwargs) in sorted(found):
+                (url, re_match, methods, callback, status) = routes[index]
+                if converts.get(index):
+                    try:
+                        kwargs = _convert(kwargs, converts[index])
+                    except ValueError:
+                        continue
+                for method in methods:
+                    if method not in winners:
+                        winners[method] = index
+                        resolved[method] = (callback, kwargs, status, index)
+                    elif index in indexes:
+                        shadowed.setdefault(index, {}).setdefault(
+                            method, winners[method])
+            self.static[path] = resolved
+        self.shadowed = []
+        for index in sorted(shadowed):
+            by_previous = {}
+            for (method, previous) in shadowed[index].items():
+                by_previous.setdefault(previous, []).append(method)
+            for previous in sorted(by_previous):
+                self.shadowed.append(
+                    (index, sorted(by_previous[previous]), previous))
+
+    def resolve(self, method, path):
+        """Return ``(callback, kwargs, status, index)`` or the allowed
+        methods.
+        """
+        if self._countdown:
+            self._countdown -= 1
+            if not self._countdown:
+                self.reorder()
+        index = self.methods.get(method)
+        found = index and index.first(path)
+        if found:
+            ((i, callback, status, convert), kwargs) = found
+            if not convert:
+                return (callback, kwargs, status, i)
+            try:
+                return (callback, _convert(kwargs, convert), status, i)
+            except ValueError:
+                pass
+            # A converter rejected the value: try the next routes in order
+            for ((i, callback, status, convert), kwargs) in index.collect(
+                    path):
+                try:
+                    return (callback, _convert(kwargs, convert), status, i)
+                except ValueError:
+                    continue
+        allowed_methods = set()
+        for ((i, methods, convert), kwargs) in self.paths.collect(path):
+            try:
+                _convert(kwargs, convert)
+            except ValueError:
+                continue
+            allowed_methods.update(methods)
+        return sorted(allowed_methods)
+
+    def match(self, method, path):
+        """Return ``(callback, kwargs, status)`` for the first route."""
+        resolved = self.static.get(path)
+        if resolved is not None:
+            rv = resolved.get(method) or sorted(resolved)
+        elif self.cache is None:
+            rv = self.resolve(method, path)
+        else:
+            rv = self.cache.get((method, path))
+            if rv is None:
+                rv = self.cache.set((method, path), self.resolve(method, path))
+        if not isinstance(rv, list):
+            if self.hits is not None:
+                self.hits[rv[3]] += 1
+            return rv[:3]
+        if rv:
+            raise MethodNotAllowed("The HTTP request method '%s' is "
+                                   "not supported." % method, allowed=rv)
+        raise NotFound("Sorry, nothing here.")
+
+    def reorder(self):
+        """Sort the regex routes by hits, where the order is irrelevant."""
+        self._countdown = self.reorder_interval
+        hits = self.hits
+        for index in self.methods.values():
+            if index.disjoint and len(index.regex_routes) > 1:
+                index.regex_routes = sorted(
+                    index.regex_routes, key=lambda route: -hits[route[1][0]])
+
+
 class Fiole(object):
     """Web Application."""
     _stack = []
+    _context = threading.local()
     static_folder = os.path.join(_get_root_folder(), 'static')
+    combined_regex = False
+    route_cache_size = 0
+    count_route_hits = False
+    max_body_size = None
+    reorder_interval = 0
+    response_cache = None
+    auto_etag = False
 
     def __init__(self):
         self.routes = []
+        self._router = None
+        self.converters = dict(URL_CONVERTERS)
+        self.json_decoder = JSON_DECODER
+        self.url_builders = {}
+        self.mounts = {}
         self.hooks = []
-        self.error_handlers = {302: http_302_found}
+        self.error_handlers = {302: http_302_found,
+                               304: http_304_not_modified,
+                               405: http_405_method_not_allowed}
         self.debug = False
 
     @classmethod
@@ -614,14 +1983,36 @@ class Fiole(object):
 
     def handle_request(self, environ, start_response):
         """The main handler.  Dispatch to the user's code."""
+        if self.mounts:
+            (segment, sep, path) = environ.get(
+                'PATH_INFO', '/')[1:].partition('/')
+            app = self.mounts.get(recode(segment))
+            if app is not None:
+                environ['SCRIPT_NAME'] = (environ.get('SCRIPT_NAME', '')
+                                          .rstrip('/') + '/' + segment)
+                environ['PATH_INFO'] = '/' + path
+                return app.handle_request(environ, start_response)
+        if self._router is None:
+            self.freeze()
         environ['fiole.app'] = self
-        request = Request(environ)
+        cache = self.response_cache
+        context = self._context
+        previous = getattr(context, 'request', None)
+        request = context.request = Request(environ)
         hooks = [hdl(request) for hdl in self.hooks]
         try:
             try:
                 for hook in hooks:
                     hook.send(None)                 # Pre-process the Request
                 (callback, kwargs, status) = self.find_matching_url(request)
+                cache = getattr(callback, 'response_cache', cache)
+                if cache is not None:
+                    body = cache.serve(environ, start_response)
+                    if body is not None:
+                        return body
+                limit = getattr(callback, 'max_body_size', self.max_body_size)
+                if limit is not None:
+                    request.limit_body(limit)
                 response = callback(request, **kwargs)
             except Exception as exc:
                 (response, status) = self.handle_error(exc, environ)
@@ -629,8 +2020,11 @@ class Fiole(object):
                 response = Response(response, status=status)
             for hook in reversed(hooks):
                 response = hook.send(response)      # Post-process the Response
+            if cache is not None:
+                return cache.send(response, environ, start_response)
             return response.send(environ, start_response)
         finally:
+            context.request = previous
             for hook in reversed(hooks):
                 hook.close()                        # Clean up
 
@@ -650,19 +2044,65 @@ class Fiole(object):
         except HTTPError as exc:
             return self.handle_error(exc, environ, level + 1)
 
+    def freeze(self):
+        """Compile the routes into the dispatch table.
+
+        Warn about the routes which are shadowed by a previous route.
+        It is called on the first request.  The table is compiled again
+        when a route is added after.
+        """
+        router = Router(self.routes, self.combined_regex,
+                        self.route_cache_size, self.converters,
+                        self.count_route_hits, self.reorder_interval)
+        for app in self.mounts.values():
+            app.freeze()
+        for (index, methods, previous) in router.shadowed:
+            warnings.warn("Route %r (%s) is shadowed by route %r" % (
+                self.routes[index][0], ', '.join(methods),
+                self.routes[previous][0]), stacklevel=2)
+        self._router = router
+        return router
+
+    def url_for(self, route_name, **params):
+        """Build the path of the named route, in the application.
+
+        It does not include the ``SCRIPT_NAME``: see
+        :meth:`Request.url_for`.  The parameters which are not in the
+        URL pattern are appended as query string.
+        """
+        return self.url_builders[route_name](params)
+
+    def get_route_stats(self):
+        """Return the list of ``(url, methods, hits, misses)`` per route.
+
+        The counters are ``None`` unless :attr:`count_route_hits` or
+        :attr:`reorder_interval` is enabled.
+        """
+        router = self._router or self.freeze()
+        (hits, misses) = (router.hits, router.misses)
+        return [(url, methods,
+                 hits and hits[index], misses and misses[index])
+                for (index, (url, re_match, methods, callback, status))
+                in enumerate(self.routes)]
+
+    def mount(self, prefix, app):
+        """Dispatch the requests below the ``prefix`` to another application.
+
+        The ``prefix`` is a single path segment, like ``'/api'``.  It is
+        moved from ``PATH_INFO`` to ``SCRIPT_NAME``.  The mounted
+        application uses its own routes and hooks.
+        """
+        segment = prefix.strip('/')
+        if not segment or '/' in segment:
+            raise ValueError("Mount prefix must be one path segment: %r" %
+                             prefix)
+        self.mounts[segment] = app
+        return app
+
     def find_matching_url(self, request):
         """Search through the methods registered."""
-        allowed_methods = set()
-        for (regex, re_match, methods, callback, status) in self.routes:
-            m = re_match(request.path)
-            if m:
-                if request.method in methods:
-                    return (callback, m.groupdict(), status)
-                allowed_methods.update(methods)
-        if allowed_methods:
-            raise MethodNotAllowed("The HTTP request method '%s' is "
-                                   "not supported." % request.method)
-        raise NotFound("Sorry, nothing here.")
+        router = self._router or self.freeze()
+        return router.match(request.method, request.path)
 
     def encode_signed(self, name, value):
         """Return a signed string with timestamp."""
@@ -722,28 +2162,48 @@ class Fiole(object):
 
     # Decorators
 
-    def route(self, url, methods=('GET', 'HEAD'), callback=None, status=200):
-        """Register a method for processing requests."""
-        def decorator(func, add=self.routes.append):
-            add((url, _url_matcher(url), tuple(methods), func, status))
+    def route(self, url, methods=('GET', 'HEAD'), callback=None, status=200,
+              name=None, max_body_size=None):
+        """Register a method for processing requests.
+
+        The ``name`` of the route is used to build its URL with
+        :meth:`url_for`.  The ``max_body_size`` overrides the limit of
+        the application for this route.
+        """
+        if name is not None:
+            if name in self.url_builders:
+                raise ValueError("Route %r is already registered" % name)
+            build = _url_builder(url)
+
+        def decorator(func):
+            re_match = _url_matcher(url, self.converters)
+            if name is not None:
+                self.url_builders[name] = build
+            if max_body_size is not None:
+                func.max_body_size = max_body_size
+            self.routes.append(
+                (url, re_match, tuple(methods), func, status))
+            self._router = None
             return func
         return decorator(callback) if callback else decorator
 
-    def get(self, url):
+    def get(self, url, name=None):
         """Register a method as capable of processing GET/HEAD requests."""
-        return self.route(url, methods=('GET', 'HEAD'))
+        return self.route(url, methods=('GET', 'HEAD'), name=name)
 
-    def post(self, url):
+    def post(self, url, name=None, max_body_size=None):
         """Register a method as capable of processing POST requests."""
-        return self.route(url, methods=('POST',))
+        return self.route(url, methods=('POST',), name=name,
+                          max_body_size=max_body_size)
 
-    def put(self, url):
+    def put(self, url, name=None, max_body_size=None):
         """Register a method as capable of processing PUT requests."""
-        return self.route(url, methods=('PUT',), status=201)
+        return self.route(url, methods=('PUT',), status=201, name=name,
+                          max_body_size=max_body_size)
 
-    def delete(self, url):
+    def delete(self, url, name=None):
         """Register a method as capable of processing DELETE requests."""
-        return self.route(url, methods=('DELETE',))
+        return self.route(url, methods=('DELETE',), name=name)
 
     def errorhandler(self, code):
         """Register a method for processing errors of a certain HTTP code."""
@@ -752,12 +2212,35 @@ class Fiole(object):
             return func
         return decorator
 
+    def converter(self, name, regex):
+        """Register a function which converts the ``<name:...>`` values.
+
+        The regex matches the value in the URL.  When the function
+        raises :exc:`ValueError`, the route does not match.
+        """
+        def decorator(func):
+            self.converters[name] = (regex, func)
+            self._router = None
+            return func
+        return decorator
+
+
+def http_304_not_modified(exception):
+    return Response(None, status=304, wrapped=True,
+                    headers=exception.etag and [('ETag', exception.etag)])
+
 
 def http_302_found(exception):
     return Response('', status=302, content_type='text/plain',
                     headers=[('Location', exception.url)])
 
 
+def http_405_method_not_allowed(exception):
+    allowed = getattr(exception, 'allowed', None)
+    return Response(HTTP_CODES[405], status=405, content_type='text/plain',
+                    headers=allowed and [('Allow', ', '.join(allowed))])
+
+
 def _make_app_wrapper(name):
     @wraps(getattr(Fiole, name))
     def wrapper(*args, **kwargs):
@@ -770,6 +2253,19 @@ post = _make_app_wrapper('post')
 put = _make_app_wrapper('put')
 delete = _make_app_wrapper('delete')
 errorhandler = _make_app_wrapper('errorhandler')
+converter = _make_app_wrapper('converter')
+
+
+def url_for(route_name, **params):
+    """Build the URL of a named route.
+
+    During a request, it is :meth:`Request.url_for`.  Otherwise it is
+    the path in the application which is on the top of the stack.
+    """
+    request = getattr(Fiole._context, 'request', None)
+    if request is None:
+        return Fiole._stack[-1].url_for(route_name, **params)
+    return request.url_for(route_name, **params)
 
 
 def get_app():
@@ -1189,6 +2685,7 @@ class Template(object):
         return self.render_template(ctx or kwargs, {}, {})
 
 engine = Engine()
+engine.global_vars['url_for'] = url_for
 
 
 def get_template(name=None, source=None, require=None):
@@ -1211,9 +2708,10 @@ def render_template(template_name=None, source=None, **context):
 
 # The WSGI HTTP server
 
-def run_wsgiref(host, port, handler):
-    """Simple HTTPServer that supports WSGI."""
-    from wsgiref.simple_server import make_server, ServerHandler
+def _patch_server_handler():
+    """Patch the ``ServerHandler`` of :mod:`wsgiref.simple_server`."""
+    from wsgiref.handlers import SimpleHandler
+    from wsgiref.simple_server import ServerHandler
 
     def cleanup_headers(self):
         # work around http://bugs.python.org/issue18099
@@ -1221,8 +2719,80 @@ def run_wsgiref(host, port, handler):
             del self.headers['Content-Length']
         elif 'Content-Length' not in self.headers:
             self.set_content_length()
+            if ('Content-Length' not in self.headers and
+                    self.status[:1] != '1' and self.status[:3] != '204' and
+                    self.environ['REQUEST_METHOD'] != 'HEAD' and
+                    self.environ.get('SERVER_PROTOCOL') == 'HTTP/1.1'):
+                # Stream the body with the chunked transfer encoding
+                self.http_version = '1.1'
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.headers['Connection'] = 'close'
     ServerHandler.cleanup_headers = cleanup_headers
 
+    def send_headers_for(self, size):
+        # The size of the first chunk is the Content-Length of a body with
+        # a single chunk; the body is chunked when it remains unknown
+        self.bytes_sent = size
+        self.send_headers()
+        self.bytes_sent = 0
+
+    def write(self, data):
+        if not self.headers_sent:
+            send_headers_for(self, len(data))
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            SimpleHandler.write(self, data)
+        elif data:
+            size = ('%x\r\n' % len(data)).encode('ascii')
+            SimpleHandler.write(self, size + data + b'\r\n')
+    ServerHandler.write = write
+
+    def finish_content(self):
+        if self.headers_sent and (
+                self.headers.get('Transfer-Encoding') == 'chunked'):
+            self._write(b'0\r\n\r\n')
+        SimpleHandler.finish_content(self)
+    ServerHandler.finish_content = finish_content
+
+    def finish_response(self):
+        sock = getattr(getattr(self, 'request_handler', None),
+                       'connection', None)
+        if not (isinstance(self.result, list) and hasattr(sock, 'sendmsg')):
+            return SimpleHandler.finish_response(self)
+        try:
+            if not self.headers_sent:
+                send_headers_for(self, sum(map(len, self.result)))
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                for data in self.result:
+                    self.write(data)
+            else:
+                self.bytes_sent += _sendmsg_all(sock, self.result)
+            self.finish_content()
+        except Exception:
+            # Keep the state for handle_error, like SimpleHandler
+            if hasattr(self.result, 'close'):
+                self.result.close()
+            raise
+        else:
+            self.close()
+    ServerHandler.finish_response = finish_response
+
+    def setup_environ(self):
+        SimpleHandler.setup_environ(self)
+        environ = self.environ
+        if hasattr(getattr(getattr(self, 'request_handler', None),
+                           'connection', None), 'sendmsg'):
+            environ['fiole.buffers'] = True     # Send the buffers as is
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            environ['wsgi.input'] = ChunkedReader(environ['wsgi.input'])
+            environ['wsgi.input_terminated'] = True
+    ServerHandler.setup_environ = setup_environ
+    return ServerHandler
+
+
+def run_wsgiref(host, port, handler):
+    """Simple HTTPServer that supports WSGI."""
+    from wsgiref.simple_server import make_server
+    _patch_server_handler()
     srv = make_server(host, port, handler)
     srv.serve_forever()
 
@@ -1232,6 +2802,7 @@ def run_fiole(app=default_app, server=run_wsgiref, host=None, port=None):
     if not hasattr(app, 'secret_key'):
         app.secret_key = base64.b64encode(os.urandom(33))
     assert app.routes, "No route defined"
+    app.freeze()
     host = host or DEFAULT_BIND['host']
     port = int(port or DEFAULT_BIND['port'])
     print('`fiole` starting up (using %s)...\nListening on http://%s:%s...\n'
@@ -106,7 +106,7 @@ def handle_single_request(environ, **kw):
     if kw:
         environ.update(kw)
     environ['wsgi.errors'] = WSGIErrors(rv)
-    environ['wsgi.input'] = FakeFile()
+    environ.setdefault('wsgi.input', FakeFile())
     start_response = StartResponse(rv)
     rv['data'] = fiole.get_app().handle_request(environ, start_response)
     assert 'status' in rv
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import copy
+import pickle
 import unittest
 
 import fiole
@@ -211,3 +213,109 @@ class AcceptTestCase(unittest.TestCase):
                                   'Image/pNg; Q=0.2, image/*; q=0.05')
         self.assertEqual(mimeaccept._parsed, [
             ('image/jpg', 0.4), ('image/png', 1.0), ('image/*', 0.05)])
+
+
+class MultiDictTestCase(unittest.TestCase):
+
+    def test_multidict(self):
+        md = fiole.MultiDict([('a', '1'), ('b', '2'), ('a', '3')])
+        self.assertEqual(md, {'a': '1', 'b': '2'})
+        self.assertEqual(md['a'], '1')
+        self.assertEqual(md.get('c', 'x'), 'x')
+        self.assertEqual(md.getall('a'), ['1', '3'])
+        self.assertEqual(md.getall('c'), [])
+        md.add('c', '4')
+        md['b'] = '5'
+        self.assertEqual(md.allitems(), [('a', '1'), ('a', '3'),
+                                         ('c', '4'), ('b', '5')])
+        del md['a']
+        self.assertEqual(md.allitems(), [('c', '4'), ('b', '5')])
+        self.assertRaises(KeyError, md.__delitem__, 'a')
+        self.assertEqual(dict(md), {'b': '5', 'c': '4'})
+
+    def test_multidict_methods(self):
+        md = fiole.MultiDict([('a', '1'), ('b', '2'), ('a', '3')])
+        md.update([('b', '4')], c='5')
+        self.assertEqual(md.allitems(), [('a', '1'), ('a', '3'),
+                                         ('b', '4'), ('c', '5')])
+        md.update(fiole.MultiDict([('c', '6'), ('c', '7')]))
+        self.assertEqual(md.getall('c'), ['6', '7'])
+        md.update({'d': '8'})
+        self.assertEqual(md['d'], '8')
+        self.assertEqual(md.pop('a'), '1')
+        self.assertEqual(md.getall('a'), [])
+        self.assertEqual(md.pop('a', 'x'), 'x')
+        self.assertRaises(KeyError, md.pop, 'a')
+        self.assertEqual(md.setdefault('b', '9'), '4')
+        self.assertEqual(md.setdefault('e', '9'), '9')
+        self.assertEqual(md.getall('e'), ['9'])
+
+        copy = md.copy()
+        self.assertIsInstance(copy, fiole.MultiDict)
+        self.assertEqual(copy.allitems(), md.allitems())
+        copy.add('b', '10')
+        self.assertEqual(md.getall('b'), ['4'])
+
+        (key, value) = md.popitem()
+        self.assertEqual(md.getall(key), [])
+        self.assertNotIn(key, dict(md.allitems()))
+        md.clear()
+        self.assertEqual((md, md.allitems()), ({}, []))
+
+    def test_multidict_copy(self):
+        md = fiole.MultiDict([('a', ['1']), ('b', ['2']), ('a', ['3'])])
+        for other in (copy.copy(md), copy.deepcopy(md),
+                      pickle.loads(pickle.dumps(md)),
+                      pickle.loads(pickle.dumps(md, 2))):
+            self.assertIsInstance(other, fiole.MultiDict)
+            self.assertEqual(other, md)
+            self.assertEqual(other.allitems(), md.allitems())
+        self.assertIs(copy.copy(md)['a'], md['a'])
+        self.assertIsNot(copy.deepcopy(md)['a'], md['a'])
+
+        md = fiole.MultiDict({'a': '1'})
+        self.assertEqual(md.allitems(), [('a', '1')])
+        self.assertEqual(fiole.MultiDict(md).allitems(), [('a', '1')])
+
+
+class EnvironHeadersTestCase(unittest.TestCase):
+
+    def test_environ_headers(self):
+        headers = fiole.EnvironHeaders({
+            'CONTENT_TYPE': 'text/plain', 'CONTENT_LENGTH': '',
+            'HTTP_CONTENT_TYPE': 'ignored', 'HTTP_X_FORWARDED_FOR': '1.2.3.4',
+            'HTTP_ACCEPT': '*/*', 'SERVER_NAME': 'localhost'})
+        self.assertEqual(len(headers), 4)
+        self.assertEqual(sorted(headers), [
+            ('Accept', '*/*'), ('Content-Length', ''),
+            ('Content-Type', 'text/plain'),
+            ('X-Forwarded-For', '1.2.3.4')])
+        self.assertEqual(headers['x-forwarded-for'], '1.2.3.4')
+        self.assertEqual(headers.get('Server-Name', 'none'), 'none')
+        self.assertEqual(headers.get_all('Content-type'), ['text/plain'])
+        self.assertEqual(headers.get_all('Cookie'), [])
+        self.assertIn('Content-Length', headers)
+        self.assertIn('accept', headers)
+        self.assertNotIn('Server-Name', headers)
+        self.assertIs(headers._list, headers._list)
+
+
+class RequestCookiesTestCase(unittest.TestCase):
+
+    def test_request_cookies(self):
+        cookies = fiole.RequestCookies(
+            'a=1; broken; b="x\\"y\\073z"; =nameless; c=; a=2; d=e=f;'
+            ' _ga=GA1.2.3')
+        self.assertEqual(sorted(cookies), ['_ga', 'a', 'b', 'c', 'd'])
+        self.assertEqual(len(cookies), 5)
+        self.assertEqual(cookies._values, {})
+        self.assertEqual(cookies['a'], '1')
+        self.assertEqual(cookies['b'], 'x"y;z')
+        self.assertEqual(cookies['c'], '')
+        self.assertEqual(cookies['d'], 'e=f')
+        self.assertEqual(sorted(cookies._values), ['a', 'b', 'c', 'd'])
+        self.assertIn('_ga', cookies)
+        self.assertNotIn('broken', cookies)
+        self.assertEqual(cookies.get('broken', 'x'), 'x')
+        self.assertRaises(KeyError, cookies.__getitem__, 'broken')
+        self.assertEqual(fiole.RequestCookies(None), {})
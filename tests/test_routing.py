@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+import unittest
+import warnings
+
+import fiole
+from ._common import PY3, handle_single_request
+u = (lambda s: s) if PY3 else (lambda s: s.decode('utf-8'))
+b = (lambda s: s.encode('utf-8')) if PY3 else (lambda s: s)
+
+
+class RouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fiole.Fiole.push()
+
+    def tearDown(self):
+        fiole.Fiole.pop()
+
+    def assertResponse(self, request, data, status='200 OK'):
+        rv = handle_single_request(request)
+        self.assertEqual(rv['status'], status)
+        if data is not None:
+            self.assertEqual(rv['data'], [b(data)])
+        return rv
+
+    def test_first_route_wins(self):
+        @fiole.get('/users/<name>')
+        def user(request, name):
+            return 'user %s' % name
+
+        @fiole.get('/users/me')
+        def user_me(request):
+            return 'me'
+
+        @fiole.get('/about/me')
+        def about_me(request):
+            return 'about me'
+
+        @fiole.get('/about/<name>')
+        def about(request, name):
+            return 'about %s' % name
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            fiole.get_app().freeze()
+        self.assertResponse('GET /users/me', 'user me')
+        self.assertResponse('GET /users/john/', 'user john')
+        self.assertResponse('GET /about/me', 'about me')
+        self.assertResponse('GET /about/john', 'about john')
+        self.assertResponse('GET /about', None, '404 Not Found')
+        self.assertResponse('GET /about/john/doe', None, '404 Not Found')
+        self.assertResponse('GET /users//', None, '404 Not Found')
+
+    def test_mixed_segments(self):
+        @fiole.get('/files/<name>.<ext>')
+        def download(request, name, ext):
+            return '%s (%s)' % (name, ext)
+
+        @fiole.get(u('/café/<_mot_>-<v_42>/plus'))
+        def route1(request, _mot_, v_42):
+            return u('%s - %s') % (_mot_, v_42)
+
+        self.assertResponse('GET /files/report.pdf', 'report (pdf)')
+        self.assertResponse('GET /files/report', None, '404 Not Found')
+        self.assertResponse(u('GET /café/thé-noir/plus'), 'thé - noir')
+
+    def test_regex_route_order(self):
+        @fiole.get(r'/num/(?P<num>\d+)')
+        def number(request, num):
+            return 'number %s' % num
+
+        @fiole.get('/num/<value>')
+        def value(request, value):
+            return 'value %s' % value
+
+        @fiole.get(r'/(?P<any>.*)')
+        def catch_all(request, any):
+            return 'any %s' % any
+
+        self.assertResponse('GET /num/42', 'number 42')
+        self.assertResponse('GET /num/forty-two', 'value forty-two')
+        self.assertResponse('GET /', None, '404 Not Found')
+        self.assertResponse('GET /a/b/c', 'any a/b/c')
+
+    def test_method_not_allowed(self):
+        @fiole.post('/items/<key>')
+        def update_item(request, key):
+            return 'updated %s' % key
+
+        @fiole.get('/items/new')
+        def new_item(request):
+            return 'new'
+
+        self.assertResponse('POST /items/new', 'updated new')
+        self.assertResponse('GET /items/new', 'new')
+        rv = self.assertResponse('GET /items/42', None,
+                                 '405 Method Not Allowed')
+        self.assertIn(('Allow', 'POST'), rv['headers'])
+        rv = self.assertResponse('DELETE /items/new', None,
+                                 '405 Method Not Allowed')
+        self.assertIn(('Allow', 'GET, HEAD, POST'), rv['headers'])
+        rv = self.assertResponse('DELETE /items/', None, '404 Not Found')
+        self.assertNotIn('Allow', dict(rv['headers']))
+
+    def test_method_indexes(self):
+        @fiole.get('/<name>')
+        def read(request, name):
+            return 'read %s' % name
+
+        @fiole.post('/<name>/<action>')
+        def action(request, name, action):
+            return '%s %s' % (action, name)
+
+        @fiole.route(r'/(?P<name>\w+)', methods=('PUT', 'DELETE'))
+        def write(request, name):
+            return '%s %s' % (request.method.lower(), name)
+
+        router = fiole.Router(fiole.get_app().routes)
+        self.assertEqual(sorted(router.methods),
+                         ['DELETE', 'GET', 'HEAD', 'POST', 'PUT'])
+        self.assertFalse(router.methods['GET'].regex_routes)
+        self.assertEqual(len(router.methods['PUT'].regex_routes), 1)
+        self.assertResponse('PUT /doc', 'put doc')
+        self.assertResponse('DELETE /doc', 'delete doc')
+        self.assertResponse('POST /doc/publish', 'publish doc')
+        self.assertResponse('GET /doc', 'read doc')
+        rv = self.assertResponse('POST /doc', None, '405 Method Not Allowed')
+        self.assertIn(('Allow', 'DELETE, GET, HEAD, PUT'), rv['headers'])
+
+    def test_static_routes(self):
+        @fiole.get('/health/')
+        def health(request):
+            return 'ok'
+
+        @fiole.route('/api/status', methods=('GET', 'POST'))
+        def status(request):
+            return 'status %s' % request.method
+
+        @fiole.get('/api/<name>')
+        def api(request, name):
+            return 'api %s' % name
+
+        router = fiole.Router(fiole.get_app().routes)
+        self.assertEqual(sorted(router.static), ['/api/status/', '/health/'])
+        self.assertEqual(sorted(router.static['/api/status/']),
+                         ['GET', 'HEAD', 'POST'])
+        self.assertResponse('GET /health', 'ok')
+        self.assertResponse('GET /health/', 'ok')
+        self.assertResponse('GET /health//', None, '404 Not Found')
+        self.assertResponse('POST /api/status', 'status POST')
+        self.assertResponse('GET /api/status/', 'status GET')
+        self.assertResponse('GET /api/version', 'api version')
+
+    def test_freeze_shadowed(self):
+        app = fiole.get_app()
+
+        @app.get('/users/<name>')
+        @app.post('/users/<name>/<action>')
+        @app.route(r'/(?P<slug>[a-z]+)', methods=('PUT',))
+        def user(request, **kwargs):
+            return 'user'
+
+        @app.route('/users/<key>', methods=('GET', 'HEAD', 'DELETE'))
+        @app.route('/users/me', methods=('GET', 'POST'))
+        @app.route('/<x>/<action>/', methods=('POST',))
+        @app.route('/users/<name>/edit', methods=('GET', 'POST'))
+        @app.route(r'/(?P<slug>[a-z]+)', methods=('GET', 'PUT'))
+        @app.route(r'/(?P<slug>\w+)', methods=('PUT',))
+        def other(request, **kwargs):
+            return 'other'
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            router = app.freeze()
+        self.assertEqual(router.shadowed, [(4, ['PUT'], 0),
+                                           (5, ['POST'], 1),
+                                           (7, ['GET'], 2),
+                                           (7, ['POST'], 6),
+                                           (8, ['GET', 'HEAD'], 2)])
+        self.assertEqual(len(caught), 5)
+        self.assertEqual(str(caught[1].message),
+                         "Route '/users/<name>/edit' (POST) is shadowed "
+                         "by route '/users/<name>/<action>'")
+        self.assertResponse('DELETE /users/me', 'other')
+        self.assertResponse('GET /users/me/edit', 'other')
+        self.assertResponse('PUT /users', 'user')
+
+    def test_converters(self):
+        @fiole.get('/items/<int:key>')
+        def item(request, key):
+            return 'item %r' % (key + 1)
+
+        @fiole.get('/items/<name>')
+        def named_item(request, name):
+            return 'named %s' % name
+
+        @fiole.get('/objects/<uuid:key>/')
+        def obj(request, key):
+            return 'object %s' % key.hex
+
+        @fiole.get('/files/<path:path>')
+        def files(request, path):
+            return 'file %s' % path
+
+        @fiole.get('/v<int:major>.<int:minor>/<str:name>')
+        def version(request, major, minor, name):
+            return '%s %d' % (name, major * 10 + minor)
+
+        self.assertResponse('GET /items/41', 'item 42')
+        self.assertResponse('GET /items/forty', 'named forty')
+        self.assertResponse('GET /objects/12345678-abcd-ef01-2345-'
+                            '6789abcdef01', 'object 12345678abcdef0123456789'
+                            'abcdef01')
+        self.assertResponse('GET /objects/1234', None, '404 Not Found')
+        self.assertResponse('GET /files/a/b/c.txt', 'file a/b/c.txt')
+        self.assertResponse('GET /files/', None, '404 Not Found')
+        self.assertResponse('GET /v1.2/doc', 'doc 12')
+        self.assertRaises(ValueError, fiole.get('/<float:x>'), files)
+
+    def test_custom_converter(self):
+        @fiole.converter('hex', r'[0-9a-fA-F]+')
+        def from_hex(value):
+            return int(value, 16)
+
+        @fiole.converter('even', r'\d+')
+        def even(value):
+            if int(value) % 2:
+                raise ValueError(value)
+            return int(value)
+
+        @fiole.get('/color/<hex:rgb>')
+        def color(request, rgb):
+            return 'color %d' % rgb
+
+        @fiole.get('/even/<even:num>')
+        def even_num(request, num):
+            return 'even %d' % num
+
+        @fiole.get('/even')
+        def even_zero(request):
+            return 'even 0'
+
+        self.assertResponse('GET /color/ff', 'color 255')
+        self.assertResponse('GET /color/fg', None, '404 Not Found')
+        self.assertResponse('GET /even/42', 'even 42')
+        self.assertResponse('GET /even/43', None, '404 Not Found')
+        self.assertResponse('GET /even', 'even 0')
+
+    def test_converter_fallback(self):
+        @fiole.converter('even', r'\d+')
+        def even(value):
+            if int(value) % 2:
+                raise ValueError(value)
+            return int(value)
+
+        @fiole.get('/n/<even:n>')
+        def even_n(request, n):
+            return 'even %d' % n
+
+        @fiole.get('/n/<n>')
+        def any_n(request, n):
+            return 'any %s' % n
+
+        @fiole.get('/m/<even:n>')
+        def even_m(request, n):
+            return 'even %d' % n
+
+        @fiole.post('/m/<n>')
+        def post_m(request, n):
+            return 'posted %s' % n
+
+        for combined in (False, True):
+            fiole.get_app().combined_regex = combined
+            fiole.get_app().freeze()
+            self.assertResponse('GET /n/4', 'even 4')
+            self.assertResponse('GET /n/3', 'any 3')
+            self.assertResponse('GET /m/4', 'even 4')
+            self.assertResponse('GET /m/3', None, '405 Method Not Allowed')
+            self.assertResponse('DELETE /m/4', None,
+                                '405 Method Not Allowed')
+
+    def test_route_added_later(self):
+        @fiole.get('/')
+        def index(request):
+            return 'index'
+
+        self.assertResponse('GET /', 'index')
+        self.assertResponse('GET /late', None, '404 Not Found')
+        router = fiole.get_app().freeze()
+        self.assertIs(fiole.get_app().freeze(), fiole.get_app()._router)
+        self.assertIsNot(fiole.get_app()._router, router)
+
+        @fiole.get('/late')
+        def late(request):
+            return 'late'
+
+        self.assertResponse('GET /late', 'late')
+
+
+class UrlForTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fiole.Fiole.push()
+
+    def tearDown(self):
+        fiole.Fiole.pop()
+
+    def test_url_for(self):
+        @fiole.get('/', name='index')
+        @fiole.get('/hello/<name>', name='hello')
+        @fiole.get('/<int:year>/<int:month>/<slug>.html', name='post')
+        @fiole.get('/files/<path:path>', name='files')
+        def view(request, **kwargs):
+            return 'view'
+
+        url_for = fiole.url_for
+        self.assertEqual(url_for('index'), '/')
+        self.assertEqual(url_for('hello', name='john'), '/hello/john')
+        self.assertEqual(url_for('hello', name='a/b c'), '/hello/a%2Fb%20c')
+        self.assertEqual(url_for('hello', name=u('thé')), '/hello/th%C3%A9')
+        self.assertEqual(url_for('post', year=2014, month=7, slug='fiole'),
+                         '/2014/7/fiole.html')
+        self.assertEqual(url_for('files', path='a/b c.txt'),
+                         '/files/a/b%20c.txt')
+        self.assertEqual(url_for('index', q='x y', page=2),
+                         '/?page=2&q=x+y')
+        self.assertRaises(KeyError, url_for, 'hello')
+        self.assertRaises(KeyError, url_for, 'unknown')
+        self.assertIs(fiole.engine.global_vars['url_for'], url_for)
+
+    def test_url_for_invalid(self):
+        fiole.get('/', name='index')(str)
+        self.assertRaises(ValueError, fiole.get, '/home', name='index')
+        self.assertRaises(ValueError, fiole.get, r'/(?P<x>\d+)', name='x')
+        # The name is free if the route is not registered
+        self.assertRaises(ValueError, fiole.get('/<bad:x>', name='x'), str)
+        fiole.get('/<x>', name='x')(str)
+        self.assertEqual(fiole.url_for('x', x=1), '/1')
+
+
+class MountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fiole.Fiole.push()
+
+    def tearDown(self):
+        fiole.Fiole.pop()
+
+    def assertResponse(self, request, data, status='200 OK', **kw):
+        rv = handle_single_request(request, **kw)
+        self.assertEqual(rv['status'], status)
+        if data is not None:
+            self.assertEqual(rv['data'], [b(data)])
+        return rv
+
+    def test_mount(self):
+        (app, api) = (fiole.get_app(), fiole.Fiole())
+        self.assertIs(app.mount('/api/', api), api)
+
+        @app.get('/<name>')
+        def main(request, name):
+            return 'main %s' % name
+
+        @api.get('/')
+        def api_index(request):
+            return 'api %s' % request.get_url('/')
+
+        @api.get('/items/<int:key>')
+        def api_item(request, key):
+            return 'item %d at %s' % (key, request.get_url())
+
+        @api.hooks.append
+        def api_hook(request):
+            response = yield
+            response.headers['X-Api'] = 'yes'
+            yield response
+
+        self.assertResponse('GET /about', 'main about')
+        rv = self.assertResponse('GET /api', 'api /api/')
+        self.assertIn(('X-Api', 'yes'), rv['headers'])
+        self.assertResponse('GET /api/items/42',
+                            'item 42 at /api/items/42/')
+        self.assertResponse('GET /api/about', None, '404 Not Found')
+        rv = self.assertResponse('GET /apis', 'main apis')
+        self.assertNotIn('X-Api', dict(rv['headers']))
+        self.assertResponse('GET /api/items/42', 'item 42 at /app/api/'
+                            'items/42/', SCRIPT_NAME='/app/')
+        self.assertRaises(ValueError, app.mount, '/', api)
+        self.assertRaises(ValueError, app.mount, '/api/v1', api)
+
+    def test_mount_url_for(self):
+        (app, api) = (fiole.get_app(), fiole.Fiole())
+        app.mount('/api', api)
+
+        @app.get('/', name='index')
+        def index(request):
+            return fiole.url_for('index')
+
+        @api.get('/items/<int:key>', name='item')
+        def api_item(request, key):
+            return '%s %s' % (fiole.url_for('item', key=key + 1),
+                              request.url_for('item', key=key))
+
+        self.assertResponse('GET /', '/')
+        self.assertResponse('GET /', '/app/', SCRIPT_NAME='/app')
+        self.assertResponse('GET /api/items/1', '/api/items/2 /api/items/1')
+        self.assertResponse('GET /api/items/1',
+                            '/app/api/items/2 /app/api/items/1',
+                            SCRIPT_NAME='/app')
+        # Outside of a request, the application on the top of the stack
+        self.assertEqual(fiole.url_for('index'), '/')
+        self.assertRaises(KeyError, fiole.url_for, 'item', key=1)
+        self.assertEqual(api.url_for('item', key=1), '/items/1')
+
+
+class CombinedRouterTestCase(RouterTestCase):
+
+    def setUp(self):
+        fiole.Fiole.push().combined_regex = True
+
+    def test_combined_patterns(self):
+        @fiole.get('/<a>/<b>')
+        def path2(request, a, b):
+            return 'path2 %s %s' % (a, b)
+
+        @fiole.get(r'/(?P<a>\w+)/(?P=a)/(?P<b>\d+)')
+        def twice(request, a, b):
+            return 'twice %s %s' % (a, b)
+
+        @fiole.get(r'/(?:b)(\w+)/\1/x')
+        def backref(request):
+            return 'backref'
+
+        @fiole.get(r'/(?P<b>[^/]+)/(?P<a>[^/]+)/(?P<c>.+)')
+        def path3(request, a, b, c):
+            return 'path3 %s %s %s' % (a, b, c)
+
+        self.assertResponse('GET /x/y', 'path2 x y')
+        self.assertResponse('GET /x/x/42', 'twice x 42')
+        self.assertResponse('GET /x/y/42', 'path3 y x 42')
+        self.assertResponse('GET /x/y/z/', 'path3 y x z')
+        self.assertResponse('GET /bz/z/x', 'backref')
+        router = fiole.Router(fiole.get_app().routes, combined=True)
+        combined = router.methods['GET'].combined
+        self.assertEqual([target and target[1] for (match, target, alts)
+                          in combined], [None, backref, None])
+        self.assertEqual(len(combined[0][2]), 2)
+
+        matchers = fiole._combine_patterns(
+            [(r'^/(?P<a>\d+)/$', 1), (r'^/(?P<b>\w+)/$', 2),
+             (r'^/(\w)\1/$', 3), (r'^/(?P<c>.*)/$', 4)], max_groups=3)
+        self.assertEqual([target for (match, target, alts) in matchers],
+                         [None, None, 3, None])
+
+
+class CachedRouterTestCase(RouterTestCase):
+
+    def setUp(self):
+        fiole.Fiole.push().route_cache_size = 4
+
+    def test_route_cache(self):
+        @fiole.get('/static')
+        def static(request):
+            return 'static'
+
+        @fiole.route('/<name>', methods=('GET', 'PUT'))
+        def index(request, name):
+            return '%s %s' % (request.method, name)
+
+        self.assertResponse('GET /static', 'static')
+        self.assertResponse('GET /one', 'GET one')
+        self.assertResponse('GET /one', 'GET one')
+        self.assertResponse('PUT /one', 'PUT one')
+        self.assertResponse('POST /one', None, '405 Method Not Allowed')
+        rv = self.assertResponse('POST /one', None, '405 Method Not Allowed')
+        self.assertIn(('Allow', 'GET, PUT'), rv['headers'])
+        self.assertResponse('GET /one/two', None, '404 Not Found')
+        cache = fiole.get_app()._router.cache
+        self.assertEqual(list(cache.data), [
+            ('GET', '/one/'), ('PUT', '/one/'), ('POST', '/one/'),
+            ('GET', '/one/two/')])
+        self.assertResponse('GET /one', 'GET one')
+        self.assertResponse('GET /two', 'GET two')
+        self.assertEqual(list(cache.data), [
+            ('POST', '/one/'), ('GET', '/one/two/'),
+            ('GET', '/one/'), ('GET', '/two/')])
+
+        @fiole.get('/one/two')
+        def one_two(request):
+            return 'one two'
+
+        self.assertResponse('GET /one/two', 'one two')
+        self.assertEqual(len(fiole.get_app()._router.cache), 0)
+
+
+class RouteStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fiole.Fiole.push()
+
+    def tearDown(self):
+        fiole.Fiole.pop()
+
+    def register(self, app):
+        @app.get('/')
+        def index(request):
+            return 'index'
+
+        @app.get(r'/num/(?P<num>\d+)')
+        def number(request, num):
+            return 'number %s' % num
+
+        @app.get(r'/hex/(?P<num>[0-9a-f]+)')
+        def hexa(request, num):
+            return 'hex %s' % num
+
+        @app.get('/users/<name>')
+        def user(request, name):
+            return 'user %s' % name
+
+    def test_route_stats(self):
+        app = fiole.get_app()
+        self.register(app)
+        self.assertEqual(app.get_route_stats()[0], ('/', ('GET', 'HEAD'),
+                                                    None, None))
+        app.count_route_hits = True
+        app.freeze()
+        for path in ('/', '/hex/ff', '/hex/ee', '/num/1', '/users/x',
+                     '/hex/gg', '/users/'):
+            handle_single_request('GET ' + path)
+        self.assertEqual([stats[2:] for stats in app.get_route_stats()],
+                         [(1, 0), (1, 4), (2, 2), (1, 0)])
+
+    def test_reorder(self):
+        app = fiole.get_app()
+        app.reorder_interval = 4
+        self.register(app)
+        router = app.freeze()
+        index = router.methods['GET']
+        self.assertTrue(index.disjoint)
+        self.assertEqual([route[1][0] for route in index.regex_routes], [1, 2])
+        for path in ('/hex/ff', '/hex/ee', '/num/1'):
+            handle_single_request('GET ' + path)
+        self.assertEqual([route[1][0] for route in index.regex_routes], [1, 2])
+        handle_single_request('GET /hex/dd')
+        self.assertEqual([route[1][0] for route in index.regex_routes], [2, 1])
+        self.assertEqual(router.misses[1:3], [2, 0])
+
+        @app.get(r'/(?P<any>.*)')
+        def catch_all(request, any):
+            return 'any'
+
+        router = app.freeze()
+        self.assertFalse(router.methods['GET'].disjoint)
+
+    def test_literal_prefix(self):
+        prefix = fiole._literal_prefix
+        self.assertEqual(prefix(r'^/api/(?P<x>\d+)/$'), '/api/')
+        self.assertEqual(prefix(r'^/a\-b\.c/$'), '/a-b.c/')
+        self.assertEqual(prefix(r'^/ab?c/$'), '/a')
+        self.assertEqual(prefix(r'^/a\.*b/$'), '/a')
+        self.assertEqual(prefix(r'^/a\d/$'), '/a')
+        self.assertEqual(prefix(r'^/a/|^/b/$'), '')
+        self.assertEqual(prefix(r'(?i)^/a/$'), '')
+        self.assertTrue(fiole._disjoint([r'^/a/$', r'^/ab/$', r'^/b\d+/$']))
+        self.assertFalse(fiole._disjoint([r'^/a/$', r'^/a/(?P<x>.*)/$']))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = fiole.LRUCache(2)
+        self.assertEqual(cache.set('a', 1), 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 42), 42)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
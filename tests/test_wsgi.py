@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 import os.path
+import socket
+import sys
 import unittest
 try:
     from cStringIO import StringIO as BytesIO
+    from StringIO import StringIO
 except ImportError:
-    from io import BytesIO
+    from io import BytesIO, StringIO
 
 import fiole
 from ._common import (PY3, ENVIRON, handle_single_request,
@@ -13,6 +16,17 @@ u = (lambda s: s) if PY3 else (lambda s: s.decode('utf-8'))
 b = (lambda s: s.encode('utf-8')) if PY3 else (lambda s: s)
 
 
+class FakeInput(list):
+    def read(self, size=-1):
+        if size < 0:
+            (chunk, self[:]) = (b('').join(self), [])
+            return chunk
+        chunk = self.pop(0) if self else b('')
+        if len(chunk) > size:
+            self.insert(0, chunk[size:])
+        return chunk[:size]
+
+
 class FioleTestCase(unittest.TestCase):
     maxDiff = 0x800
 
@@ -261,6 +275,354 @@ class FioleTestCase(unittest.TestCase):
         self.assertEqual(rv.output, 'W00t')
         self.assertEqual(rv.headers['Content-Type'], html_utf8)
 
+    def test_streaming_response(self):
+        closed = []
+
+        @fiole.get('/report')
+        def report(request):
+            try:
+                yield u('Hällo ')
+                yield b('')
+                yield b('Wörld')
+            finally:
+                closed.append(request.method)
+
+        @fiole.get('/latin')
+        def latin(request):
+            response = fiole.Response(iter([u('Hällo')]))
+            response.charset = 'latin-1'
+            return response
+
+        rv = handle_single_request('GET /report')
+        self.assertNoError(rv)
+        self.assertEqual(rv['headers'],
+                         [('Content-Type', 'text/html; charset=utf-8')])
+        self.assertFalse(closed)
+        self.assertEqual(list(rv['data']), [b('Hällo '), b('Wörld')])
+        self.assertEqual(closed, ['GET'])
+
+        rv = handle_single_request('GET /report')
+        self.assertEqual(next(rv['data']), b('Hällo '))
+        rv['data'].close()
+        self.assertEqual(closed, ['GET', 'GET'])
+
+        rv = handle_single_request('HEAD /report')
+        self.assertEqual(rv['data'], [])
+
+        rv = handle_single_request('GET /latin')
+        self.assertEqual(list(rv['data']), [u('Hällo').encode('latin-1')])
+
+    def test_compress_response(self):
+        import zlib
+        fiole.get_app().hooks.append(fiole.compress_response)
+        text = u('Hällo Wörld! ') * 100
+
+        @fiole.get('/text')
+        def text_view(request):
+            return text
+
+        @fiole.get('/small')
+        def small(request):
+            return 'Hi!'
+
+        @fiole.get('/png')
+        def png(request):
+            return fiole.Response(b('x') * 2000, content_type='image/png')
+
+        @fiole.get('/report')
+        def report(request):
+            for idx in range(100):
+                yield u('Hällo Wörld! ')
+
+        rv = handle_single_request('GET /text',
+                                   HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+        headers = dict(rv['headers'])
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(headers['Content-Length']), len(rv['data'][0]))
+        self.assertEqual(zlib.decompress(rv['data'][0]), text.encode('utf-8'))
+
+        rv = handle_single_request('GET /report', HTTP_ACCEPT_ENCODING='gzip')
+        headers = dict(rv['headers'])
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        data = b('').join(rv['data'])
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                         text.encode('utf-8'))
+
+        rv = handle_single_request('GET /text')
+        headers = dict(rv['headers'])
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(rv['data'], [text.encode('utf-8')])
+
+        for path in ('/small', '/png'):
+            rv = handle_single_request('GET ' + path,
+                                       HTTP_ACCEPT_ENCODING='gzip')
+            self.assertNotIn('Content-Encoding', dict(rv['headers']))
+
+        response = fiole.Response('x' * 10, headers={'Vary': 'Cookie'})
+        response.compress(fiole.Accept('Accept-Encoding', 'br'), min_size=0)
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(response.output, 'x' * 10)
+
+    def test_response_cache(self):
+        app = fiole.get_app()
+        app.response_cache = cache = fiole.ResponseCache(max_size=2000)
+        app.hooks.append(fiole.compress_response)
+        calls = []
+
+        @fiole.get('/page')
+        def page(request):
+            calls.append(request.query)
+            return 'Page %s ' % request.query * 200
+
+        @fiole.get('/login')
+        def login(request):
+            calls.append('login')
+            response = fiole.Response('Welcome')
+            response.set_cookie('session', 'abc')
+            return response
+
+        rv = handle_single_request('GET /page?a')
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(handle_single_request('GET /page?a'), rv)
+        self.assertEqual(handle_single_request('HEAD /page?a'),
+                         dict(rv, data=[]))
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(len(cache), 1)
+
+        # Vary: Accept-Encoding
+        gzipped = handle_single_request('GET /page?a',
+                                        HTTP_ACCEPT_ENCODING='gzip')
+        self.assertIn(('Content-Encoding', 'gzip'), gzipped['headers'])
+        self.assertEqual(handle_single_request(
+            'GET /page?a', HTTP_ACCEPT_ENCODING='gzip'), gzipped)
+        self.assertEqual(handle_single_request('GET /page?a'), rv)
+        self.assertEqual(calls, ['a', 'a'])
+
+        # The least recently used entries are dropped
+        handle_single_request('GET /page?b')
+        self.assertEqual(calls, ['a', 'a', 'b'])
+        self.assertLessEqual(cache.size, cache.max_size)
+        handle_single_request('GET /page?a')
+        self.assertEqual(calls, ['a', 'a', 'b', 'a'])
+
+        # Not cached
+        handle_single_request('POST /page?a')
+        handle_single_request('GET /login')
+        handle_single_request('GET /login')
+        handle_single_request('GET /missing')
+        self.assertEqual(calls, ['a', 'a', 'b', 'a', 'login', 'login'])
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_response_cache_authorization(self):
+        app = fiole.get_app()
+        app.response_cache = cache = fiole.ResponseCache()
+
+        @app.hooks.append
+        def authenticate(request):
+            response = yield
+            if request.path == '/secret/' and (
+                    'HTTP_AUTHORIZATION' not in request.environ):
+                response = fiole.Response('Login required', status=403)
+            yield response
+
+        @fiole.get('/secret')
+        def secret(request):
+            return 'secret data'
+
+        @fiole.get('/shared')
+        def shared(request):
+            return fiole.Response('shared data',
+                                  headers={'Cache-Control': 'public'})
+
+        rv = handle_single_request('GET /secret',
+                                   HTTP_AUTHORIZATION='Basic dXNlcg==')
+        self.assertEqual(rv['data'], [b('secret data')])
+        self.assertEqual(len(cache), 0)
+        rv = handle_single_request('GET /secret')
+        self.assertEqual(rv['status'], '403 Forbidden')
+
+        handle_single_request('GET /shared',
+                              HTTP_AUTHORIZATION='Basic dXNlcg==')
+        self.assertEqual(len(cache), 1)
+
+    def test_response_cache_cookie(self):
+        app = fiole.get_app()
+        app.response_cache = cache = fiole.ResponseCache()
+
+        @fiole.get('/hello')
+        def hello(request):
+            return 'hello %s' % request.get_cookie('user')
+
+        @fiole.get('/varying')
+        def varying(request):
+            return fiole.Response('hello %s' % request.get_cookie('user'),
+                                  headers={'Vary': 'Cookie'})
+
+        for path in ('/hello', '/varying'):
+            for user in ('alice', 'bob'):
+                rv = handle_single_request('GET ' + path,
+                                           HTTP_COOKIE='user=' + user)
+                self.assertEqual(rv['data'], [b('hello ' + user)])
+            rv = handle_single_request('GET ' + path)
+            self.assertEqual(rv['data'], [b('hello None')])
+        # The responses to the sessions are stored if they vary on Cookie
+        self.assertEqual(len(cache), 4)
+        for path in ('/hello', '/varying'):
+            rv = handle_single_request('GET ' + path,
+                                       HTTP_COOKIE='user=alice')
+            self.assertEqual(rv['data'], [b('hello alice')])
+        self.assertEqual(len(cache), 4)
+
+    def test_response_cache_vary_index(self):
+        cache = fiole.ResponseCache(max_size=500)
+
+        @fiole.get('/p')
+        @cache
+        def page(request):
+            return 'Page %s' % request.query
+
+        for idx in range(50):
+            handle_single_request('GET /p?q=%d' % idx)
+        self.assertLessEqual(cache.size, cache.max_size)
+        self.assertEqual(len(cache.vary), len(cache))
+
+        expired = fiole.ResponseCache(ttl=-1)
+        page.response_cache = expired
+        handle_single_request('GET /p?q=1')
+        self.assertEqual(len(expired.vary), 1)
+        handle_single_request('GET /p?q=2')
+        self.assertEqual(expired.get(dict(ENVIRON, PATH_INFO='/p',
+                                          QUERY_STRING='q=1')), None)
+        self.assertEqual((len(expired), len(expired.vary)), (1, 1))
+
+    def test_response_cache_route(self):
+        cache = fiole.ResponseCache(ttl=-1)
+        calls = []
+
+        @fiole.get('/expired')
+        @cache
+        def expired(request):
+            calls.append(request.path)
+            return 'Expired'
+
+        @fiole.get('/other')
+        def other(request):
+            calls.append(request.path)
+            return 'Other'
+
+        for path in ('/expired', '/expired', '/other', '/other'):
+            rv = handle_single_request('GET ' + path)
+            self.assertEqual(rv['data'], [b(path[1:].title())])
+        self.assertEqual(calls, ['/expired/', '/expired/',
+                                 '/other/', '/other/'])
+        self.assertEqual(len(cache), 1)
+
+    def test_etag(self):
+        import hashlib
+        app = fiole.get_app()
+        rendered = []
+
+        @fiole.get('/page')
+        def page(request):
+            return 'Hello'
+
+        @fiole.get('/article/<int:num>')
+        def article(request, num):
+            request.check_etag('rev%d' % num)
+            rendered.append(num)
+            return 'Article %d' % num
+
+        @fiole.get('/tagged')
+        def tagged(request):
+            return fiole.Response('Tagged', headers={'ETag': '"v1"'})
+
+        rv = handle_single_request('GET /page')
+        self.assertNotIn('ETag', dict(rv['headers']))
+
+        app.auto_etag = True
+        etag = '"%s"' % hashlib.sha1(b('Hello')).hexdigest()
+        rv = handle_single_request('GET /page')
+        self.assertEqual(dict(rv['headers'])['ETag'], etag)
+        self.assertEqual(rv['data'], [b('Hello')])
+        for if_none_match in (etag, '"other", W/' + etag, '*'):
+            rv = handle_single_request('GET /page',
+                                       HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(rv['status'], '304 Not Modified')
+            self.assertEqual(rv['headers'], [('ETag', etag)])
+            self.assertEqual(rv['data'], [])
+        rv = handle_single_request('GET /page', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(rv['status'], '200 OK')
+
+        rv = handle_single_request('GET /tagged', HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual(rv['status'], '304 Not Modified')
+
+        # Short-circuit before rendering
+        rv = handle_single_request('GET /article/42')
+        self.assertEqual(dict(rv['headers'])['ETag'], 'W/"rev42"')
+        self.assertEqual(rendered, [42])
+        rv = handle_single_request('GET /article/42',
+                                   HTTP_IF_NONE_MATCH='"rev42"')
+        self.assertEqual(rv['status'], '304 Not Modified')
+        self.assertEqual(rv['headers'], [('ETag', 'W/"rev42"')])
+        self.assertEqual(rv['data'], [])
+        self.assertEqual(rendered, [42])
+
+        # The cached responses are validated too
+        app.response_cache = fiole.ResponseCache()
+        rv = handle_single_request('GET /page')
+        rv = handle_single_request('GET /page', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rv['status'], '304 Not Modified')
+        self.assertEqual(rv['headers'], [('ETag', etag)])
+        self.assertEqual(len(app.response_cache), 1)
+
+    def test_buffer_response(self):
+        view = memoryview(b('ghi'))
+
+        @fiole.get('/buffers')
+        def buffers(request):
+            return [b('abc'), bytearray(b('def')), view, b(''), u('é')]
+
+        @fiole.get('/bytearray')
+        def from_bytearray(request):
+            return bytearray(b('Hällo'))
+
+        rv = handle_single_request('GET /buffers')
+        self.assertIn(('Content-Length', '11'), rv['headers'])
+        self.assertEqual(rv['data'], [b('abc'), b('def'), b('ghi'), b('é')])
+        self.assertTrue(all(type(chunk) is bytes for chunk in rv['data']))
+
+        rv = handle_single_request('GET /bytearray')
+        self.assertIn(('Content-Length', '6'), rv['headers'])
+        self.assertEqual(rv['data'], [b('Hällo')])
+
+        if not PY3:     # The socket of Python 2 has no sendmsg
+            return
+        # The server sends the buffers without copy
+        rv = handle_single_request('GET /buffers', **{'fiole.buffers': True})
+        self.assertIn(('Content-Length', '11'), rv['headers'])
+        self.assertEqual([bytes(chunk) for chunk in rv['data']],
+                         [b('abc'), b('def'), b('ghi'), b('é')])
+        self.assertIs(rv['data'][2].obj, view.obj)
+
+    def test_sendmsg_all(self):
+        sent = []
+
+        class FakeSocket(object):
+            def sendmsg(self, buffers):
+                data = b('').join(bytes(bytearray(buf))
+                                  for buf in buffers)[:4]
+                sent.append(data)
+                return len(data)
+
+        buffers = [b('abc'), bytearray(b('defgh')), memoryview(b('ij'))]
+        self.assertEqual(fiole._sendmsg_all(FakeSocket(), buffers), 10)
+        self.assertEqual(sent, [b('abcd'), b('efgh'), b('ij')])
+
     def test_none_response(self):
 
         @fiole.get('/')
@@ -320,6 +682,11 @@ class FioleTestCase(unittest.TestCase):
         self.assertEqual(request.POST['files'].type, 'text/plain')
         self.assertEqual(request.POST['files'].disposition, 'form-data')
 
+        environ['wsgi.input'] = BytesIO(FORM_DATA_1)
+        request = fiole.Request(environ)
+        self.assertEqual(request.body, FORM_DATA_1)
+        self.assertEqual(request.POST['submit-name'], 'Larry')
+
         self.assertFalse(hasattr(request, 'db'))
         self.assertRaises(AttributeError, getattr, request, 'db')
 
@@ -349,6 +716,293 @@ class FioleTestCase(unittest.TestCase):
         self.assertEqual(files['file2.gif'].type, 'image/gif')
         self.assertEqual(files['file2.gif'].disposition, 'file')
 
+    def test_form_data_large(self):
+        content = b('0123456789') * 10000 + b('\r\n--AaB03')
+        form_data = b('\r\n').join([
+            b('preamble'), b('--AaB03x'),
+            b('Content-Disposition: form-data; name="title"'), b(''),
+            u('Café').encode('utf-8'), b('--AaB03x'),
+            b('Content-Disposition: form-data; name="data"; '
+              'filename="C:\\\\dir\\\\big \\"file\\".bin"'),
+            b('Content-Type: application/octet-stream'), b(''),
+            content, b('--AaB03x'),
+            b('Content-Disposition: form-data; name="title"'), b(''),
+            b(''), b('--AaB03x--'), b('')])
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': len(form_data),
+            'CONTENT_TYPE': FORM_DATA_CONTENT_TYPE,
+            'wsgi.input': BytesIO(form_data),
+        })
+        request = fiole.Request(environ)
+        request.buffer_size = 1000
+        request.spool_size = 50000
+        self.assertEqual(sorted(request.POST), ['data', 'title'])
+        self.assertEqual(request.POST['title'], 'Café')
+        self.assertEqual(request.POST.getall('title'), ['Café', ''])
+        upload = request.POST['data']
+        self.assertEqual(upload.name, 'data')
+        self.assertEqual(upload.filename, 'C:\\dir\\big "file".bin')
+        self.assertEqual(upload.type, 'application/octet-stream')
+        self.assertTrue(upload.file._rolled)
+        self.assertEqual(upload.value, content)
+
+        environ['wsgi.input'] = BytesIO(form_data)
+        request = fiole.Request(environ)
+        request.spool_size = 3
+        self.assertRaises(fiole.BadRequest, getattr, request, 'POST')
+
+        environ['wsgi.input'] = BytesIO(form_data[:-20])
+        request = fiole.Request(environ)
+        self.assertRaises(fiole.BadRequest, getattr, request, 'POST')
+
+    def test_form_urlencoded(self):
+        form_data = b('name=Larry&lang=en&lang=fr&empty=&city=S%C3%A8te')
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': len(form_data),
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded; '
+                            'charset=utf-8',
+            'wsgi.input': BytesIO(form_data),
+        })
+        environ['QUERY_STRING'] = 'q=a+b%26c&flag&q=&=x'
+        request = fiole.Request(environ)
+        self.assertEqual(request.POST, {'name': 'Larry', 'lang': 'en',
+                                        'city': u('Sète') if PY3 else
+                                        'S\xc3\xa8te'})
+        self.assertEqual(request.POST.getall('lang'), ['en', 'fr'])
+        self.assertEqual(request.GET, {'q': 'a b&c', 'flag': '', '': 'x'})
+        self.assertEqual(request.GET.allitems(), [('q', 'a b&c'),
+                                                  ('flag', ''), ('q', ''),
+                                                  ('', 'x')])
+
+        # The body is read before the form
+        environ['wsgi.input'] = BytesIO(form_data)
+        request = fiole.Request(environ)
+        self.assertEqual(request.body, form_data)
+        self.assertEqual(request.POST.getall('lang'), ['en', 'fr'])
+
+        # The media type is parsed, and compared exactly
+        for (content_type, parsed) in [
+                (' Application/X-WWW-Form-Urlencoded ', True),
+                ('application/x-www-form-urlencodedfoo', False)]:
+            environ.update({'CONTENT_TYPE': content_type,
+                            'wsgi.input': BytesIO(form_data)})
+            request = fiole.Request(environ)
+            self.assertEqual('lang' in request.POST, parsed)
+
+    def test_request_stream(self):
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'PUT',
+            'CONTENT_LENGTH': '10',
+            'wsgi.input': BytesIO(b('0123456789-not-the-body')),
+        })
+        request = fiole.Request(environ)
+        request.buffer_size = 4
+        self.assertEqual(list(request.stream),
+                         [b('0123'), b('4567'), b('89')])
+        self.assertEqual(request.body, b(''))
+
+        environ['wsgi.input'] = BytesIO(b('0123456789-not-the-body'))
+        request = fiole.Request(environ)
+        buf = bytearray(6)
+        self.assertEqual(request.readinto(buf), 6)
+        self.assertEqual(bytes(buf), b('012345'))
+        self.assertEqual(request.readinto(buf), 4)
+        self.assertEqual(bytes(buf[:4]), b('6789'))
+        self.assertEqual(request.readinto(buf), 0)
+
+        environ['wsgi.input'] = FakeInput([b('0123'), b('456789')])
+        request = fiole.Request(environ)
+        self.assertEqual(request.readinto(buf), 4)
+        self.assertEqual(request.read(3), b('456'))
+        self.assertEqual(request.body, b('789'))
+
+        environ['wsgi.input'] = FakeInput([b('0123'), b('45'), b('6789')])
+        self.assertEqual(fiole.Request(environ).body, b('0123456789'))
+
+    def test_request_read_body_into(self):
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'PUT',
+            'CONTENT_LENGTH': '10',
+            'wsgi.input': FakeInput([b('0123'), b('456789'), b('-')]),
+        })
+        buf = bytearray(16)
+        view = fiole.Request(environ).read_body_into(buf)
+        self.assertEqual(view.tobytes(), b('0123456789'))
+        self.assertEqual(bytes(buf[:10]), b('0123456789'))
+
+        environ['wsgi.input'] = BytesIO(b('0123456789'))
+        request = fiole.Request(environ)
+        self.assertRaises(fiole.RequestEntityTooLarge,
+                          request.read_body_into, bytearray(8))
+        environ['wsgi.input'] = BytesIO(b('0123456789'))
+        view = fiole.Request(environ).read_body_into(bytearray(10))
+        self.assertEqual(view.tobytes(), b('0123456789'))
+
+        # The buffer of the thread is reused, and it grows
+        environ['wsgi.input'] = BytesIO(b('0123456789'))
+        view = fiole.Request(environ).read_body_into()
+        self.assertEqual(view.tobytes(), b('0123456789'))
+        buf = fiole.Request._buffers.body
+        environ['wsgi.input'] = BytesIO(b('abc'))
+        environ['CONTENT_LENGTH'] = '3'
+        view = fiole.Request(environ).read_body_into()
+        self.assertEqual(view.tobytes(), b('abc'))
+        self.assertIs(fiole.Request._buffers.body, buf)
+
+        # The Content-Length does not size the buffer
+        environ['wsgi.input'] = BytesIO(b('abcd'))
+        environ['CONTENT_LENGTH'] = '3221225472'
+        view = fiole.Request(environ).read_body_into()
+        self.assertEqual(view.tobytes(), b('abcd'))
+        self.assertIs(fiole.Request._buffers.body, buf)
+
+        del environ['CONTENT_LENGTH']
+        environ.update({'wsgi.input': BytesIO(b('x') * (len(buf) + 5)),
+                        'wsgi.input_terminated': True})
+        view = fiole.Request(environ).read_body_into()
+        self.assertEqual(view.tobytes(), b('x') * (len(buf) + 5))
+        self.assertEqual(len(fiole.Request._buffers.body), 2 * len(buf))
+
+    def test_max_body_size(self):
+        app = fiole.get_app()
+        app.max_body_size = 8
+
+        @fiole.put('/small')
+        def put_small(request):
+            return request.body
+
+        @fiole.put('/large', max_body_size=16)
+        def put_large(request):
+            return request.body
+
+        for (path, size, status) in [('/small', 8, '201'),
+                                     ('/small', 9, '413'),
+                                     ('/large', 16, '201'),
+                                     ('/large', 17, '413')]:
+            rv = handle_single_request('PUT ' + path,
+                                       CONTENT_LENGTH=str(size),
+                                       **{'wsgi.input': BytesIO(b('x') * 20)})
+            self.assertEqual(rv['status'][:3], status)
+        self.assertIs(app.routes[1][3], put_large)
+        self.assertEqual(put_large.max_body_size, 16)
+
+    def test_request_input_terminated(self):
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'PUT',
+            'wsgi.input': BytesIO(b('0123456789')),
+            'wsgi.input_terminated': True,
+        })
+        request = fiole.Request(environ)
+        self.assertEqual(request.content_length, 0)
+        self.assertEqual(request.read(4), b('0123'))
+        self.assertEqual(request.body, b('456789'))
+
+        # Without wsgi.input_terminated, the body is empty
+        del environ['wsgi.input_terminated']
+        environ['wsgi.input'] = BytesIO(b('0123456789'))
+        self.assertEqual(fiole.Request(environ).body, b(''))
+
+        environ.update({
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'wsgi.input': FakeInput([b('a=1&'), b('b=2')]),
+            'wsgi.input_terminated': True,
+        })
+        self.assertEqual(fiole.Request(environ).POST.allitems(),
+                         [('a', '1'), ('b', '2')])
+
+        environ['wsgi.input'] = BytesIO(b('x') * 20)
+        request = fiole.Request(environ)
+        request.limit_body(8)
+        self.assertEqual(request.read(8), b('x') * 8)
+        self.assertRaises(fiole.RequestEntityTooLarge, request.read, 1)
+        request = fiole.Request(dict(environ, **{
+            'wsgi.input': BytesIO(b('x') * 20)}))
+        request.limit_body(8)
+        self.assertRaises(fiole.RequestEntityTooLarge, getattr,
+                          request, 'body')
+
+    def test_chunked_reader(self):
+        raw = b('4\r\nWiki\r\n6;name=value\r\npedia \r\n'
+                'E\r\nin \r\n\r\nchunks.\r\n0\r\nX-Trailer: 1\r\n\r\nnext')
+        stream = BytesIO(raw)
+        reader = fiole.ChunkedReader(stream)
+        self.assertEqual(reader.read(3), b('Wik'))
+        self.assertEqual(reader.read(5), b('ipedi'))
+        self.assertEqual(reader.read(), b('a in \r\n\r\nchunks.'))
+        self.assertEqual(reader.read(), b(''))
+        self.assertEqual(stream.read(), b('next'))
+
+        environ = dict(ENVIRON)
+        environ.update({
+            'REQUEST_METHOD': 'PUT',
+            'wsgi.input': fiole.ChunkedReader(BytesIO(raw)),
+            'wsgi.input_terminated': True,
+        })
+        request = fiole.Request(environ)
+        request.buffer_size = 4
+        self.assertEqual(b('').join(request.stream),
+                         b('Wikipedia in \r\n\r\nchunks.'))
+
+        for raw in ['x\r\nabc\r\n', '-1\r\n', '4\r\nab']:
+            reader = fiole.ChunkedReader(BytesIO(b(raw)))
+            self.assertRaises(fiole.BadRequest, reader.read)
+
+    def test_request_lazy_fields(self):
+        environ = dict(ENVIRON)
+        environ.update({'PATH_INFO': '/foo', 'SCRIPT_NAME': '/app/',
+                        'REQUEST_METHOD': 'post', 'CONTENT_LENGTH': 'x'})
+        request = fiole.Request(environ)
+        self.assertEqual((request.path, request.method), ('/foo/', 'POST'))
+        self.assertEqual(request.__dict__, {})
+        self.assertRaises(AttributeError, object.__getattribute__,
+                          request, 'headers')
+        self.assertEqual(request.script_name, '/app')
+        self.assertEqual(request.content_length, 0)
+        self.assertIsInstance(request.headers, fiole.EnvironHeaders)
+        self.assertIs(object.__getattribute__(request, 'headers'),
+                      request.headers)
+        self.assertEqual(request.__dict__, {})
+        request.db = 'connection'
+        self.assertEqual(request.__dict__, {'db': 'connection'})
+        self.assertEqual(request.SERVER_NAME, 'fakehost.invalid')
+
+    def test_request_json(self):
+        body = u('{"name": "Café", "tags": [1, 2]}').encode('utf-8')
+        decoded = []
+
+        def decoder(data):
+            decoded.append(data)
+            return fiole.JSON_DECODER(data)
+
+        @fiole.post('/api')
+        def post_api(request):
+            self.assertIs(request.json, request.json)
+            return ','.join(sorted(request.json or ['none']))
+
+        fiole.get_app().json_decoder = decoder
+        for (content_type, data, status, output) in [
+                ('application/json', body, '200 OK', 'name,tags'),
+                ('application/vnd.api+json; charset=utf-8', body, '200 OK',
+                 'name,tags'),
+                ('text/plain', body, '200 OK', 'none'),
+                ('application/json', b(''), '200 OK', 'none'),
+                ('application/json', b('{"name"'), '400 Bad Request',
+                 None)]:
+            rv = handle_single_request('POST /api', CONTENT_TYPE=content_type,
+                                       CONTENT_LENGTH=str(len(data)),
+                                       **{'wsgi.input': BytesIO(data)})
+            self.assertEqual(rv['status'], status)
+            if output is not None:
+                self.assertEqual(rv['data'], [b(output)])
+        self.assertEqual(decoded, [body, body, b('{"name"')])
+
     def test_upload(self):
 
         @fiole.post('/upload')
@@ -581,3 +1235,110 @@ class FioleTestCase(unittest.TestCase):
                                     'pre-process request',
                                     'release resource'])
         del captured[:]
+
+
+class ServerHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        fiole._patch_server_handler()
+        app = fiole.Fiole.push()
+        self.server = make_server('127.0.0.1', 0, app.handle_request,
+                                  handler_class=QuietHandler)
+
+    def tearDown(self):
+        self.server.server_close()
+        fiole.Fiole.pop()
+
+    def request(self, data):
+        """Send the raw request, return (status, headers, body)."""
+        (client, conn) = socket.socketpair()
+        try:
+            client.sendall(data)
+            self.server.finish_request(conn, ('127.0.0.1', 0))
+            self.server.shutdown_request(conn)
+            output = b('').join(iter(lambda: client.recv(65536), b('')))
+        finally:
+            client.close()
+        (head, sep, body) = output.partition(b('\r\n\r\n'))
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        return (lines[0], headers, body)
+
+    def test_list_response(self):
+        @fiole.get('/list')
+        def single_chunk(request):
+            return fiole.Response([b('abcd')], wrapped=True)
+
+        (status, headers, body) = self.request(
+            b('GET /list HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+        self.assertEqual(status[9:], '200 OK')
+        self.assertEqual(headers['Content-Length'], '4')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual(body, b('abcd'))
+
+    def test_generator_response(self):
+        @fiole.get('/gen')
+        def generator(request):
+            yield 'ab'
+            yield 'cd'
+
+        (status, headers, body) = self.request(
+            b('GET /gen HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+        self.assertEqual(status[9:], '200 OK')
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(body, b('2\r\nab\r\n2\r\ncd\r\n0\r\n\r\n'))
+
+        # HTTP/1.0 does not support the chunked encoding
+        (status, headers, body) = self.request(b('GET /gen HTTP/1.0\r\n\r\n'))
+        self.assertEqual(status[9:], '200 OK')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual(body, b('abcd'))
+
+        (status, headers, body) = self.request(
+            b('HEAD /gen HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+        self.assertEqual(status[9:], '200 OK')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual(body, b(''))
+
+    def test_chunked_request(self):
+        @fiole.put('/echo')
+        def echo(request):
+            return request.body
+
+        (status, headers, body) = self.request(b(
+            'PUT /echo HTTP/1.1\r\nHost: localhost\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n'
+            '4\r\nabcd\r\n2\r\nef\r\n0\r\n\r\n'))
+        self.assertEqual(status[9:], '201 Created')
+        self.assertEqual(headers['Content-Length'], '6')
+        self.assertEqual(body, b('abcdef'))
+
+    def test_sendmsg_error(self):
+        @fiole.get('/list')
+        def buffers(request):
+            return fiole.Response([b('abcd')], wrapped=True)
+
+        def sendmsg_all(sock, buffers):
+            raise OSError("sendmsg failed")
+        (sendmsg_all_orig, fiole._sendmsg_all) = (fiole._sendmsg_all,
+                                                  sendmsg_all)
+        (stderr, sys.stderr) = (sys.stderr, StringIO())
+        try:
+            (status, headers, body) = self.request(
+                b('GET /list HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+            errors = sys.stderr.getvalue()
+        finally:
+            (fiole._sendmsg_all, sys.stderr) = (sendmsg_all_orig, stderr)
+        if PY3:     # No error page after the headers
+            self.assertIn('sendmsg failed', errors)
+            self.assertEqual(status[9:], '200 OK')
+            self.assertEqual(body, b(''))
+        else:       # The socket has no sendmsg
+            self.assertEqual(body, b('abcd'))